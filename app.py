@@ -1,30 +1,33 @@
 import time
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from datetime import datetime
 import os
 import json
-import plotly.express as px
-import requests
-
-# 嘗試匯入 yfinance
-try:
-    import yfinance as yf
-except ImportError:
-    pass 
+import importlib
+import tempfile
+import uuid
+from core import (
+    SheetConnectionError, AGING_LABELS, EXPORT_FORMATS,
+    normalize_text, parse_taiwan_date, auto_classify_category, next_id_for_year,
+    set_service_account_info, search_gov_company_data, get_yahoo_rate,
+    get_data_snapshot, invalidate_data_snapshot, CompanyDirectoryView,
+    FX_CURRENCIES, parse_rate_description, ensure_fx_history, fx_table_version, convert_revenue,
+    build_typed_frame, build_dashboard_frame, build_receivables_report, export_dataset,
+    bulk_enrich_tax_ids, save_gcis_cache, write_enrichment_to_sheet,
+    smart_save_record, update_company_category_in_sheet, update_tax_id_in_sheet,
+)
 
 # ==========================================
 # 📍 設定區
 # ==========================================
-SPREADSHEET_KEY = '1Q1-JbHje0E-8QB0pu83OHN8jCPY8We9l2j1_7eZ8yas'
-
 # 初始化 Session State
 if 'current_page' not in st.session_state: st.session_state['current_page'] = "📝 新增業務登記"
 if 'edit_mode' not in st.session_state: st.session_state['edit_mode'] = False
 if 'edit_data' not in st.session_state: st.session_state['edit_data'] = {}
 if 'ex_res' not in st.session_state: st.session_state['ex_res'] = ""
+if 'ex_currency' not in st.session_state: st.session_state['ex_currency'] = "TWD"
+if 'ex_rate' not in st.session_state: st.session_state['ex_rate'] = 0.0
 if 'inv_list' not in st.session_state: st.session_state['inv_list'] = []
 if 'pay_list' not in st.session_state: st.session_state['pay_list'] = []
 
@@ -41,300 +44,19 @@ if 'temp_new_data' not in st.session_state: st.session_state['temp_new_data'] =
 # 結構: {'類別名稱': ['公司A', '公司B']}
 
 # ==========================================
-# ☁️ Google Sheets 連線與工具函式
-# ==========================================
-def get_google_sheet_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    for attempt in range(3):
-        try:
-            if "gcp_service_account" in st.secrets:
-                key_dict = json.loads(st.secrets["gcp_service_account"]["json_content"])
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(key_dict, scope)
-            else:
-                local_key_file = r'service_account.json'
-                if os.path.exists(local_key_file):
-                    creds = ServiceAccountCredentials.from_json_keyfile_name(local_key_file, scope)
-                else:
-                    local_key_file_old = r'C:\Users\User\Desktop\業務登記表\service_account.json'
-                    if os.path.exists(local_key_file_old):
-                        creds = ServiceAccountCredentials.from_json_keyfile_name(local_key_file_old, scope)
-                    else:
-                        st.error("❌ 找不到金鑰檔案 (service_account.json)！")
-                        st.stop()
-            return gspread.authorize(creds)
-        except Exception as e:
-            if "503" in str(e): time.sleep(2); continue
-            st.error(f"連線失敗: {e}"); st.stop()
-    st.error("❌ Google 伺服器忙線中"); st.stop()
-
-def clean_headers(headers):
-    cleaned = []
-    seen = {}
-    for i, col in enumerate(headers):
-        c = str(col).strip()
-        if not c: c = f"未命名_{i}"
-        if c in seen: seen[c] += 1; c = f"{c}_{seen[c]}"
-        else: seen[c] = 0
-        cleaned.append(c)
-    return cleaned
-
-def parse_taiwan_date(date_str):
-    if pd.isna(date_str) or str(date_str).strip() == "": return pd.NaT
-    s = str(date_str).split(',')[0].strip().replace(".", "/")
-    try:
-        parts = s.split('/')
-        if len(parts) == 2:
-            this_year = datetime.now().year
-            return pd.to_datetime(f"{this_year}-{parts[0]}-{parts[1]}")
-        elif len(parts) == 3:
-            year_val = int(parts[0])
-            if year_val < 1911: year_val += 1911
-            return pd.to_datetime(f"{year_val}-{parts[1]}-{parts[2]}")
-        else: return pd.to_datetime(s)
-    except: return pd.NaT
-
-def get_worksheet_safe(sh, possible_names, index_fallback):
-    for name in possible_names:
-        try: return sh.worksheet(name)
-        except: pass
-    try: return sh.get_worksheet(index_fallback)
-    except: return None
-
-# ==========================================
-# 🌍 外部 API 查詢功能
-# ==========================================
-def search_gov_company_data(tax_id):
-    try:
-        url = f"https://data.gcis.nat.gov.tw/od/data/api/9D17AE0D-09B5-4732-A8F4-81ADED04B679?$format=json&$filter=Business_Accounting_NO eq {tax_id}"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0: return data[0].get("Company_Name", "")
-        
-        url_biz = f"https://data.gcis.nat.gov.tw/od/data/api/426D5542-5F05-43EB-83F9-F1300F14E1F1?$format=json&$filter=Business_Accounting_NO eq {tax_id}"
-        response = requests.get(url_biz, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0: return data[0].get("Business_Name", "")
-    except Exception as e: print(f"API Error: {e}")
-    return None
-
-def auto_classify_category(company_name, existing_categories):
-    if not company_name: return None
-    for cat in existing_categories:
-        if len(cat) >= 2 and cat in company_name: return cat
-            
-    keyword_map = {
-        "營造": "工程", "建設": "工程", "工程": "工程", "土木": "工程",
-        "機電": "機械設備", "機械": "機械設備", "精密": "機械設備", "工業": "機械設備", "設備": "機械設備",
-        "電力": "能源電力", "發電": "能源電力", "能源": "能源電力", "汽電": "能源電力",
-        "客運": "交通運輸", "海運": "交通運輸", "物流": "交通運輸", "捷運": "交通運輸", "鐵路": "交通運輸", "航運": "交通運輸", "車輛": "交通運輸", "汽車": "交通運輸",
-        "科技": "電子家電", "電子": "電子家電", "半導體": "電子家電", "光電": "電子家電", "電路": "電子家電", "資訊": "軟體科技", "軟體": "軟體科技", "數位": "軟體科技",
-        "實業": "五金", "五金": "五金", "金屬": "五金",
-        "貿易": "貿易", "企業": "貿易", "國際": "貿易",
-        "塑膠": "塑膠化工", "化學": "塑膠化工", "化工": "塑膠化工", "材料": "建材", "建材": "建材"
-    }
-    
-    for key, val in keyword_map.items():
-        if key in company_name:
-            if val in existing_categories: return val
-    return None
-
-@st.cache_data(ttl=60)
-def load_data_from_gsheet():
-    for attempt in range(3):
-        try:
-            client = get_google_sheet_client()
-            sh = client.open_by_key(SPREADSHEET_KEY)
-            
-            ws_c = get_worksheet_safe(sh, ["公司名稱", "Company List"], 1)
-            cd = {}
-            if ws_c:
-                data = ws_c.get_all_values()
-                if len(data) > 0:
-                    headers = [str(h).strip() for h in data[0]]
-                    max_rows = len(data)
-                    for col_idx, category in enumerate(headers):
-                        if not category: continue 
-                        clients = []
-                        for row_idx in range(1, max_rows):
-                            if col_idx < len(data[row_idx]):
-                                val = str(data[row_idx][col_idx]).strip()
-                                if val: clients.append(val)
-                        cd[category] = clients
-            
-            ws_f = get_worksheet_safe(sh, ["業務表單", "業務資料表", "工作表1", "Sheet1"], 0)
-            df_b = pd.DataFrame()
-            if ws_f:
-                all_values = ws_f.get_all_values()
-                header_idx = -1
-                for i, row in enumerate(all_values[:10]):
-                    r_str = [str(r).strip() for r in row]
-                    if "編號" in r_str and "日期" in r_str: header_idx = i; break
-                
-                if header_idx != -1 and len(all_values) > header_idx + 1:
-                    headers = clean_headers(all_values[header_idx])
-                    df_b = pd.DataFrame(all_values[header_idx+1:], columns=headers)
-                    if '編號' in df_b.columns: df_b = df_b[df_b['編號'].astype(str).str.strip() != '']
-
-            ws_t = get_worksheet_safe(sh, ["統一編號", "Tax ID"], 2)
-            tax_map = {}
-            rev_tax_map = {}
-            
-            if ws_t:
-                t_data = ws_t.get_all_values()
-                if len(t_data) > 1:
-                    for row in t_data[1:]:
-                        if len(row) >= 3:
-                            c_cat = str(row[0]).strip()
-                            c_name = str(row[1]).strip()
-                            c_tax = str(row[2]).strip()
-                            if c_name and c_tax:
-                                tax_map[c_name] = c_tax
-                                rev_tax_map[c_tax] = {"name": c_name, "cat": c_cat}
-
-            return cd, df_b, tax_map, rev_tax_map
-        except Exception as e:
-            if "503" in str(e): time.sleep(2); continue
-            return {}, pd.DataFrame(), {}, {}
-    return {}, pd.DataFrame(), {}, {}
-
-# ==========================================
-# 🛠️ 資料寫入邏輯
+# ☁️ Google Sheets 連線
 # ==========================================
-def update_company_category_in_sheet(client_name, new_category):
-    try:
-        client = get_google_sheet_client()
-        sh = client.open_by_key(SPREADSHEET_KEY)
-        ws = get_worksheet_safe(sh, ["公司名稱"], 1)
-        if not ws: return False
-        
-        all_cols = ws.get_all_values()
-        if not all_cols: return False
-        
-        headers = [h.strip() for h in all_cols[0]]
-        if new_category in headers: new_col_idx = headers.index(new_category) + 1
-        else: new_col_idx = len(headers) + 1; ws.update_cell(1, new_col_idx, new_category); headers.append(new_category)
-
-        found_row, found_col = None, None
-        for c_idx, col_name in enumerate(headers):
-            col_vals = [row[c_idx] for row in all_cols if len(row) > c_idx]
-            if client_name in col_vals:
-                r_idx = col_vals.index(client_name); found_row = r_idx + 1; found_col = c_idx + 1; break
-        
-        if not found_row:
-            new_col_values = ws.col_values(new_col_idx)
-            next_row = len(new_col_values) + 1
-            ws.update_cell(next_row, new_col_idx, client_name)
-        return True
-    except: return False
-
-def update_tax_id_in_sheet(client_cat, client_name, tax_id):
-    if not client_name or not tax_id: return
-    try:
-        client = get_google_sheet_client()
-        sh = client.open_by_key(SPREADSHEET_KEY)
-        ws = get_worksheet_safe(sh, ["統一編號"], 2)
-        if not ws: return
-
-        cell = None
-        try: cell = ws.find(client_name, in_column=2)
-        except: pass
-
-        if cell: 
-            ws.update_cell(cell.row, 3, str(tax_id))
-            if client_cat: ws.update_cell(cell.row, 1, client_cat)
-        else: 
-            ws.append_row([client_cat, client_name, str(tax_id)])
-    except: pass
-
-def smart_save_record(data_dict, is_update=False):
-    for attempt in range(3):
-        try:
-            client = get_google_sheet_client()
-            sh = client.open_by_key(SPREADSHEET_KEY)
-            ws = get_worksheet_safe(sh, ["業務表單", "業務資料表", "Sheet1"], 0)
-            
-            all_values = ws.get_all_values()
-            headers = []
-            for i, row in enumerate(all_values[:10]):
-                r_str = [str(r).strip() for r in row]
-                if "編號" in r_str and "日期" in r_str: headers = row; break
-            if not headers: return False, "找不到標題列"
-
-            row_to_write = [""] * len(headers)
-            for col_name, value in data_dict.items():
-                try:
-                    idx = next(i for i, h in enumerate(headers) if str(h).strip() == col_name)
-                    row_to_write[idx] = str(value)
-                except StopIteration: pass
-
-            target_id = str(data_dict.get("編號"))
-            if is_update:
-                try:
-                    id_col_idx = headers.index("編號")
-                    id_list = ws.col_values(id_col_idx + 1)
-                    try:
-                        row_index = id_list.index(target_id) + 1
-                        ws.update(f"A{row_index}", [row_to_write], value_input_option='USER_ENTERED')
-                        return True, f"編號 {target_id} 更新成功"
-                    except ValueError: return False, "找不到原始編號"
-                except Exception as ex: return False, str(ex)
-            else:
-                ws.append_row(row_to_write, value_input_option='USER_ENTERED')
-                return True, f"編號 {target_id} 新增成功"
-        except Exception as e:
-            if "503" in str(e): time.sleep(2); continue
-            return False, f"寫入失敗: {e}"
-    return False, "連線逾時"
-
-def calculate_next_id(df_all, target_year):
-    if df_all.empty: return 1
-    date_col = next((c for c in df_all.columns if '日期' in c), None)
-    if not date_col or '編號' not in df_all.columns: return 1
-    try:
-        df_temp = df_all[['編號', date_col]].copy()
-        df_temp['id_num'] = pd.to_numeric(df_temp['編號'], errors='coerce')
-        df_temp = df_temp.dropna(subset=['id_num'])
-        def get_strict_year(x):
-            if pd.isna(x) or str(x).strip() == "": return None
-            s = str(x).strip().replace(".", "/").replace("-", "/")
-            parts = s.split('/')
-            if len(parts) == 3:
-                try:
-                    y = int(parts[0])
-                    if y < 1911: y += 1911
-                    return y
-                except: return None
-            return None
-        df_temp['parsed_year'] = df_temp[date_col].apply(get_strict_year)
-        df_target = df_temp[df_temp['parsed_year'] == target_year]
-        if df_target.empty: return 1
-        return int(df_target['id_num'].max()) + 1
-    except: return 1
-
-def get_yahoo_rate(target_currency, query_date, inverse=False):
-    try:
-        ticker_symbol = f"{target_currency}TWD=X"
-        check_date = query_date
-        for _ in range(5):
-            start_d = check_date.strftime("%Y-%m-%d")
-            end_d = (check_date + timedelta(days=1)).strftime("%Y-%m-%d")
-            df = yf.download(ticker_symbol, start=start_d, end=end_d, progress=False)
-            if not df.empty:
-                try: raw_rate = float(df['Close'].iloc[0])
-                except: raw_rate = float(df['Close'].values[0])
-                if inverse: return 1 / raw_rate, check_date, None
-                else: return raw_rate, check_date, None
-            check_date -= timedelta(days=1)
-    except: pass
-    return None, None, "無法取得匯率"
+def init_sheet_connection():
+    """將 st.secrets 的金鑰交給 core (client 由 core 在同一個 process 內共用)"""
+    if "gcp_service_account" in st.secrets:
+        set_service_account_info(json.loads(st.secrets["gcp_service_account"]["json_content"]))
 
 # ==========================================
 # 🚀 主程式
 # ==========================================
 def main():
     st.set_page_config(page_title="雲端業務系統", layout="wide", page_icon="☁️")
+    init_sheet_connection()
     
     with st.sidebar:
         st.title("功能選單")
@@ -361,28 +83,19 @@ def main():
             
         st.markdown("---")
         if st.button("🔄 強制重新整理"):
-            st.cache_data.clear()
+            invalidate_data_snapshot()
             st.session_state['temp_new_data'] = {} # 清空臨時資料
             st.rerun()
 
     with st.spinner("資料載入中..."):
-        company_dict, df_business, tax_map, rev_tax_map = load_data_from_gsheet()
-        
-        # 🔥 關鍵修正：將臨時記憶體中的新公司，合併回 company_dict
-        # 這樣即使頁面刷新，剛剛找到的新公司也不會消失
-        if 'temp_new_data' in st.session_state:
-            for temp_cat, temp_clients in st.session_state['temp_new_data'].items():
-                if temp_cat not in company_dict:
-                    company_dict[temp_cat] = temp_clients
-                else:
-                    # 合併並去重
-                    existing = company_dict[temp_cat]
-                    for tc in temp_clients:
-                        if tc not in existing:
-                            existing.insert(0, tc) # 插入最前面
-                    company_dict[temp_cat] = existing
+        try: snapshot = get_data_snapshot()
+        except SheetConnectionError as e: st.error(str(e)); st.stop()
+        except Exception as e: st.error(f"資料載入失敗: {e}"); st.stop()
+        df_business, tax_map, rev_tax_map = snapshot.df_business, snapshot.tax_map, snapshot.rev_tax_map
 
-    def normalize_text(text): return str(text).replace('臺', '台').strip()
+        # 🔥 關鍵修正：將臨時記憶體中的新公司疊加在共用名單上 (不複製、不修改共用快照)
+        # 這樣即使頁面刷新，剛剛找到的新公司也不會消失
+        company_dict = CompanyDirectoryView(snapshot.company_dict, st.session_state['temp_new_data'])
 
     # ========================================================
     # 頁面 1: 業務登記
@@ -394,6 +107,7 @@ def main():
         
         def_date = datetime.today()
         def_project, def_price, def_remark, def_ex_res = "", 0, "", st.session_state.get('ex_res', "")
+        def_currency, def_rate = st.session_state.get('ex_currency', "TWD"), st.session_state.get('ex_rate', 0.0)
         has_inv_init, has_pay_init, has_del_init, has_ship_init = False, False, False, False
         def_inv_date, def_pay_date = datetime.today(), datetime.today()
         d_del_def = datetime.today()
@@ -424,6 +138,10 @@ def main():
                 def_price = int(float(p)) if p and p.replace(".","").isdigit() else 0
                 def_remark = edit_data.get('備註', "")
                 def_ex_res = edit_data.get('進出口匯率', "")
+                p_cur, p_rate = parse_rate_description(def_ex_res)
+                def_currency = str(edit_data.get('幣別') or p_cur or "TWD").strip().upper()
+                r = str(edit_data.get('匯率', "")).replace(",", "")
+                def_rate = float(r) if r.replace(".", "", 1).isdigit() else (p_rate or 0.0)
 
                 if 'edit_loaded' not in st.session_state:
                     cat_key = edit_data.get('客戶類別')
@@ -521,11 +239,6 @@ def main():
                         if found_client not in st.session_state['temp_new_data'][found_cat]:
                             st.session_state['temp_new_data'][found_cat].append(found_client)
 
-                        # 更新 company_dict (為了當下的計算)
-                        if found_cat not in company_dict: company_dict[found_cat] = []
-                        if found_client not in company_dict[found_cat]:
-                            company_dict[found_cat].insert(0, found_client)
-
                     cat_options = list(company_dict.keys()) + ["➕ 新增類別..."]
                     
                     if found_cat:
@@ -588,7 +301,7 @@ def main():
 
             with c2:
                 if is_edit: current_id = edit_data.get('編號'); st.metric(label="✨ 編輯案件編號", value=f"No. {current_id}")
-                else: next_id = calculate_next_id(df_business, input_date.year); st.metric(label=f"✨ {input_date.year} 新案件編號", value=f"No. {next_id}", delta="Auto")
+                else: next_id = next_id_for_year(snapshot, input_date.year); st.metric(label=f"✨ {input_date.year} 新案件編號", value=f"No. {next_id}", delta="Auto")
                 
                 col_tax_input, col_tax_btn = st.columns([3, 1])
                 with col_tax_input:
@@ -623,9 +336,6 @@ def main():
                                     if found_cat not in st.session_state['temp_new_data']: st.session_state['temp_new_data'][found_cat] = []
                                     if found_client not in st.session_state['temp_new_data'][found_cat]:
                                         st.session_state['temp_new_data'][found_cat].append(found_client)
-                                    
-                                    if found_cat not in company_dict: company_dict[found_cat] = []
-                                    if found_client not in company_dict[found_cat]: company_dict[found_cat].insert(0, found_client)
 
                                 cat_ops = list(company_dict.keys()) + ["➕ 新增類別..."]
                                 if found_cat and found_cat in cat_ops:
@@ -681,8 +391,13 @@ def main():
                             if st.button("清", key="clr_pay"): st.session_state['pay_list'] = []; st.rerun()
             
             st.divider()
-            col_ex_input, col_ex_btn = st.columns([3, 1])
+            col_ex_input, col_ex_cur, col_ex_rate = st.columns([3, 1, 1])
             with col_ex_input: final_ex = st.text_input("匯率內容", value=def_ex_res, placeholder="匯率將顯示於此")
+            with col_ex_cur:
+                cur_options = ["TWD"] + FX_CURRENCIES
+                if def_currency not in cur_options: cur_options.append(def_currency)
+                final_currency = st.selectbox("💱 幣別", cur_options, index=cur_options.index(def_currency))
+            with col_ex_rate: final_rate = st.number_input("匯率 (1 外幣 = ? TWD)", min_value=0.0, value=float(def_rate), step=0.001, format="%.5f")
             with st.expander("🔍 匯率查詢小工具"):
                 e1, e2, e3, e4 = st.columns(4)
                 with e1: q_date = st.date_input("查詢日期", datetime.today())
@@ -694,7 +409,10 @@ def main():
                         if r:
                             desc = f"{d.strftime('%Y/%m/%d')} 1 {q_curr} = {r:.3f} TWD"
                             if is_inverse: desc = f"{d.strftime('%Y/%m/%d')} 1 TWD = {r:.5f} {q_curr}"
-                            st.session_state['ex_res'] = desc; st.rerun()
+                            st.session_state['ex_res'] = desc
+                            st.session_state['ex_currency'] = q_curr
+                            st.session_state['ex_rate'] = 1 / r if is_inverse else r
+                            st.rerun()
                         else: st.error("查無資料")
 
         st.write("")
@@ -738,6 +456,8 @@ def main():
                     "發票日期": ids_str,
                     "收款日期": pds_str,
                     "進出口匯率": final_ex,
+                    "幣別": final_currency,
+                    "匯率": f"{final_rate:.5f}" if final_currency != "TWD" and final_rate > 0 else "",
                     "備註": remark
                 }
                 
@@ -754,6 +474,8 @@ def main():
                         st.success(" | ".join(msg_list))
                         
                         st.session_state['ex_res'] = ""
+                        st.session_state['ex_currency'] = "TWD"
+                        st.session_state['ex_rate'] = 0.0
                         st.session_state['inv_list'] = []
                         st.session_state['pay_list'] = []
                         st.session_state['edit_mode'] = False
@@ -768,7 +490,7 @@ def main():
                         if 'client_box' in st.session_state: del st.session_state['client_box']
                         if 'temp_new_data' in st.session_state: st.session_state['temp_new_data'] = {} # 存檔成功後清空臨時記憶
 
-                        st.cache_data.clear()
+                        invalidate_data_snapshot()
                         time.sleep(2)
                         st.rerun()
                     else: st.error(f"儲存失敗: {msg}")
@@ -778,52 +500,126 @@ def main():
     # ========================================================
     elif st.session_state['current_page'] == "📊 數據戰情室":
         st.title("📊 數據戰情室")
+
+        with st.expander("🧾 統編批次查核"):
+            st.caption("比對公司名單、業務紀錄與統編表，向經濟部商業司查詢缺漏或未核對的統編。")
+            dry_run = st.checkbox("僅產生報告 (不寫入雲端)", value=True, key="enrich_dry_run")
+            if st.button("🚀 開始查核", key="enrich_run"):
+                with st.spinner("批次查詢政府資料庫中..."):
+                    report = bulk_enrich_tax_ids(company_dict, df_business, tax_map, rev_tax_map)
+                    save_gcis_cache()
+                st.session_state['enrich_report'] = report
+                if not dry_run:
+                    success, msg = write_enrichment_to_sheet(report)
+                    if success: st.success(msg); invalidate_data_snapshot()
+                    else: st.error(msg)
+            report = st.session_state.get('enrich_report')
+            if report is not None:
+                if not report: st.info("沒有需要查核的資料。")
+                else:
+                    df_report = pd.DataFrame(report)
+                    st.write(df_report['狀態'].str.split(':').str[0].value_counts().to_dict())
+                    st.dataframe(df_report, use_container_width=True, hide_index=True)
+
         if df_business.empty: st.info("目前尚無資料。")
         else:
-            df_clean = df_business.copy()
-            price_col = next((c for c in df_clean.columns if '價格' in c or '金額' in c), None)
-            if price_col:
-                df_clean[price_col] = df_clean[price_col].astype(str).str.replace(',', '').replace('', '0')
-                df_clean[price_col] = pd.to_numeric(df_clean[price_col], errors='coerce').fillna(0)
-            
-            date_col = next((c for c in df_clean.columns if '日期' in c), None)
-            if date_col:
-                df_clean['parsed_date'] = df_clean[date_col].apply(parse_taiwan_date)
-                df_valid = df_clean.dropna(subset=['parsed_date']).copy()
-                df_valid['Year'] = df_valid['parsed_date'].dt.year
+            df_valid, price_col = snapshot.get_derived("dashboard_frame", build_dashboard_frame)
+            if df_valid is not None:
+                px = importlib.import_module("plotly.express")
                 all_years = sorted(df_valid['Year'].unique().astype(int), reverse=True)
-                selected_year = st.selectbox("📅 請選擇年份", all_years)
+                col_year, col_cur = st.columns(2)
+                with col_year: selected_year = st.selectbox("📅 請選擇年份", all_years)
+                with col_cur: display_currency = st.selectbox("💱 顯示幣別", ["TWD"] + FX_CURRENCIES, key="display_currency")
                 df_final = df_valid[df_valid['Year'] == selected_year].sort_values(by='parsed_date', ascending=False)
-                
-                total_rev = df_final[price_col].sum() if price_col else 0
+
+                # 非台幣時以本機匯率表換算 (同一資料版本 + 匯率表版本只算一次)，切換幣別不需重新查詢
+                value_col, money = price_col, "$"
+                if price_col and display_currency != "TWD":
+                    with st.spinner("更新匯率資料..."):
+                        ensure_fx_history(display_currency, df_valid['parsed_date'])
+                    converted = snapshot.get_derived(
+                        ("revenue", display_currency, fx_table_version()),
+                        lambda snap: convert_revenue(df_valid, price_col, display_currency, snap.get_rows("fx_fields")))
+                    value_col, money = f"金額 ({display_currency})", f"{display_currency} "
+                    df_final = df_final.assign(**{value_col: converted.reindex(df_final.index)})
+                    missing_fx = int(df_final[value_col].isna().sum())
+                    if missing_fx: st.caption(f"⚠️ {missing_fx} 筆紀錄缺少 {display_currency} 匯率，未計入換算金額。")
+
+                total_rev = df_final[value_col].sum() if value_col else 0
                 st.markdown(f"### 📊 {selected_year} 年度總覽")
                 k1, k2, k3 = st.columns(3)
-                k1.metric("總營業額", f"${total_rev:,.0f}")
+                k1.metric("總營業額", f"{money}{total_rev:,.0f}")
                 k2.metric("總案件數", f"{len(df_final)} 件")
                 avg = total_rev/len(df_final) if len(df_final) > 0 else 0
-                k3.metric("平均客單價", f"${avg:,.0f}")
+                k3.metric("平均客單價", f"{money}{avg:,.0f}")
                 
                 st.markdown("---")
                 c_chart1, c_chart2 = st.columns(2)
                 with c_chart1:
                     st.subheader("📈 客戶類別佔比")
                     cat_col = next((c for c in df_final.columns if '類別' in c), None)
-                    if cat_col and price_col:
-                        fig_pie = px.pie(df_final, names=cat_col, values=price_col, hole=0.4)
+                    if cat_col and value_col:
+                        fig_pie = px.pie(df_final, names=cat_col, values=value_col, hole=0.4)
                         st.plotly_chart(fig_pie, use_container_width=True)
                 with c_chart2:
                     st.subheader("📅 每月業績趨勢")
-                    if price_col and 'parsed_date' in df_final.columns:
-                        df_monthly = df_final.resample('M', on='parsed_date')[price_col].sum().reset_index()
+                    if value_col and 'parsed_date' in df_final.columns:
+                        df_monthly = df_final.resample('M', on='parsed_date')[value_col].sum().reset_index()
                         df_monthly['Month_Str'] = df_monthly['parsed_date'].dt.strftime('%Y-%m')
-                        fig_bar = px.bar(df_monthly, x='Month_Str', y=price_col, title="月營收分佈", labels={'Month_Str':'月份', price_col:'金額'})
+                        fig_bar = px.bar(df_monthly, x='Month_Str', y=value_col, title="月營收分佈", labels={'Month_Str':'月份', value_col:'金額'})
                         st.plotly_chart(fig_bar, use_container_width=True)
                 
+                st.markdown("---")
+                st.subheader("💰 應收帳款與帳齡")
+                ar = snapshot.get_derived("receivables", build_receivables_report)
+                if not ar: st.info("尚無發票資料。")
+                else:
+                    a1, a2, a3 = st.columns(3)
+                    a1.metric("未收款總額", f"${ar['outstanding_total']:,.0f}")
+                    a2.metric("未收款發票", f"{ar['outstanding_count']} 張")
+                    a3.metric("平均收款天數", f"{ar['avg_days_to_pay']:.0f} 天" if ar['avg_days_to_pay'] is not None else "-")
+
+                    c_ar1, c_ar2 = st.columns(2)
+                    with c_ar1:
+                        bucket_totals = ar['aging'][AGING_LABELS].sum().reset_index()
+                        bucket_totals.columns = ['帳齡', '金額']
+                        fig_aging = px.bar(bucket_totals, x='帳齡', y='金額', title="帳齡分佈")
+                        st.plotly_chart(fig_aging, use_container_width=True)
+                    with c_ar2:
+                        if len(ar['days_to_pay']):
+                            fig_days = px.histogram(ar['days_to_pay'].to_frame(), x='收款天數', nbins=30, title="收款天數分佈")
+                            st.plotly_chart(fig_days, use_container_width=True)
+
+                    st.dataframe(ar['aging'], use_container_width=True, hide_index=True)
+                    with st.expander("📄 未收款發票明細"):
+                        st.dataframe(ar['open_invoices'], use_container_width=True, hide_index=True)
+
+                st.markdown("---")
+                with st.expander("📤 匯出資料"):
+                    x1, x2, x3 = st.columns(3)
+                    with x1: export_scope = st.radio("範圍", [f"{selected_year} 年度", "全部歷史資料"], key="export_scope")
+                    with x2: export_fmt = st.radio("格式", list(EXPORT_FORMATS.keys()), key="export_fmt")
+                    with x3:
+                        if st.button("📦 產生匯出檔", key="export_run"):
+                            if export_scope == "全部歷史資料": df_export, _ = snapshot.get_derived("typed_frame", build_typed_frame)
+                            else: df_export = df_final
+                            if 'export_token' not in st.session_state: st.session_state['export_token'] = uuid.uuid4().hex
+                            dest = os.path.join(tempfile.gettempdir(), f"business_export_{st.session_state['export_token']}{EXPORT_FORMATS[export_fmt]}")
+                            with st.spinner("匯出中..."):
+                                try:
+                                    export_dataset(df_export, price_col, export_fmt, dest)
+                                    st.session_state['export_file'] = dest
+                                except Exception as e: st.error(f"匯出失敗: {e}")
+                    export_file = st.session_state.get('export_file')
+                    if export_file and os.path.exists(export_file):
+                        with open(export_file, 'rb') as f:
+                            st.download_button("⬇️ 下載匯出檔", f, file_name=f"業務資料_{datetime.today().strftime('%Y%m%d')}{os.path.splitext(export_file)[1]}", key="export_download")
+
                 st.markdown("---")
                 st.subheader(f"📝 {selected_year} 詳細資料")
                 st.warning("💡 **操作提示：** 請直接點選表格中的任一列，系統將自動跳轉至編輯頁面並帶入該筆資料。")
 
-                display_cols = [c for c in df_final.columns if c not in ['Year', 'parsed_date']]
+                display_cols = [c for c in df_final.columns if c not in ['Year', 'parsed_date'] and (c == price_col or c != value_col)]
                 selection = st.dataframe(df_final[display_cols], use_container_width=True, on_select="rerun", selection_mode="single-row", hide_index=True)
 
                 if selection and selection["selection"]["rows"]:
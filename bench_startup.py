@@ -0,0 +1,53 @@
+"""
+啟動時間量測：每個模組各自在全新的 Python process 中匯入，回報匯入耗時。
+
+用法：
+    python bench_startup.py            # 預設每個模組量 5 次取中位數
+    python bench_startup.py -n 10
+
+"core" 為 cli.py 排程工具的啟動成本；"app (bare)" 代表以 bare mode 匯入 app.py 的成本，也就是每次冷啟動第一次執行腳本前必付的代價；
+懶載入的模組 (plotly / gspread / oauth2client / yfinance) 不應再計入這一項。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "streamlit",
+    "pandas",
+    "requests",
+    "plotly.express",
+    "gspread",
+    "oauth2client.service_account",
+    "yfinance",
+    "core",
+]
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def time_import(stmt, repeat):
+    code = f"import time; t0 = time.perf_counter(); {stmt}; print(time.perf_counter() - t0)"
+    samples = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True)
+        if proc.returncode != 0: return None
+        samples.append(float(proc.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description="量測各模組冷啟動匯入耗時")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = [(m, time_import(f"import {m}", args.repeat)) for m in MODULES]
+    rows.append(("app (bare)", time_import("import app", args.repeat)))
+
+    width = max(len(name) for name, _ in rows)
+    print(f"{'module'.ljust(width)}  median (ms)")
+    for name, sec in rows:
+        print(f"{name.ljust(width)}  {'missing' if sec is None else f'{sec * 1000:10.1f}'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+排程 / 命令列用的批次工具，不需要啟動 Streamlit。所有指令的結果都以 JSON 輸出到 stdout。
+
+用法：
+    python cli.py sync --out backups/                   # 每晚同步：下載雲端資料並存一份本機備份
+    python cli.py export --format Excel --year 2024 --out 2024.xlsx
+    python cli.py import new_records.csv [--apply]      # 批次匯入紀錄 (預設只檢查不寫入)
+    python cli.py enrich [--apply]                      # 統編批次查核
+    python cli.py warm-cache --days 30                  # 預熱匯率表與 GCIS 查詢快取
+
+金鑰來源依序為 GCP_SERVICE_ACCOUNT_JSON (金鑰內容)、GCP_SERVICE_ACCOUNT_FILE (金鑰路徑)、service_account.json。
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+
+import core
+
+def emit(result, ok=True):
+    result = {"ok": ok, **result}
+    print(json.dumps(result, ensure_ascii=False, default=str))
+    return 0 if ok else 1
+
+def load_snapshot():
+    return core.DataSnapshot(1, *core.load_data_from_gsheet())
+
+def cmd_sync(args):
+    snapshot = load_snapshot()
+    df_typed, price_col = snapshot.get_derived("typed_frame", core.build_typed_frame)
+    os.makedirs(args.out, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d")
+    records_path = core.export_dataset(df_typed, price_col, args.format, os.path.join(args.out, f"business_{stamp}{core.EXPORT_FORMATS[args.format]}"))
+    directory_path = os.path.join(args.out, f"directory_{stamp}.json")
+    with open(directory_path, 'w', encoding='utf-8') as f:
+        json.dump({"company_dict": {k: list(v) for k, v in snapshot.company_dict.items()}, "tax_map": dict(snapshot.tax_map)}, f, ensure_ascii=False)
+
+    ar = snapshot.get_derived("receivables", core.build_receivables_report)
+    return emit({
+        "records": len(snapshot.df_business),
+        "categories": len(snapshot.company_dict),
+        "companies": sum(len(v) for v in snapshot.company_dict.values()),
+        "tax_ids": len(snapshot.tax_map),
+        "outstanding_total": ar["outstanding_total"] if ar else 0,
+        "outstanding_count": ar["outstanding_count"] if ar else 0,
+        "files": [records_path, directory_path],
+    })
+
+def cmd_export(args):
+    snapshot = load_snapshot()
+    if args.year:
+        df, price_col = snapshot.get_derived("dashboard_frame", core.build_dashboard_frame)
+        if df is None: return emit({"error": "資料表中找不到日期欄位"}, ok=False)
+        df = df[df['Year'] == args.year]
+    else:
+        df, price_col = snapshot.get_derived("typed_frame", core.build_typed_frame)
+    path = core.export_dataset(df, price_col, args.format, args.out)
+    return emit({"rows": len(df), "file": path})
+
+def id_key(value):
+    """編號的比對鍵：數字編號去掉前導零與小數 (例如 "05"、"5.0" 都視為 "5")"""
+    s = str(value).strip()
+    if s.lower() == "nan": return ""
+    num = pd.to_numeric(s, errors='coerce')
+    return str(int(num)) if pd.notna(num) and float(num).is_integer() else s
+
+def read_import_file(path):
+    if path.lower().endswith((".xlsx", ".xls")): return pd.read_excel(path, dtype=str).fillna("")
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def cmd_import(args):
+    df_new = read_import_file(args.file)
+    missing = [c for c in ['日期', '客戶名稱'] if c not in df_new.columns]
+    if missing: return emit({"error": f"缺少欄位: {', '.join(missing)}"}, ok=False)
+
+    snapshot = load_snapshot()
+    ids = snapshot.get_rows("ids")
+    taken = set(zip(ids["year"], snapshot.df_business.loc[ids.index, '編號'].map(id_key))) if len(ids) else set()
+
+    # 先收下有效的紀錄與檔案中指定的編號 (與既有紀錄或檔案內重複者列為錯誤)，再從各年度最大編號之後自動編號
+    valid, errors = [], []
+    for line_no, row in enumerate(df_new.to_dict('records'), start=2):
+        d = core.parse_taiwan_date(row['日期'])
+        if d is pd.NaT or not str(row['客戶名稱']).strip():
+            errors.append({"line": line_no, "error": "日期或客戶名稱無效"}); continue
+        row['日期'] = d.strftime("%Y-%m-%d")
+        row_id = id_key(row.get('編號', ''))
+        if row_id:
+            if (d.year, row_id) in taken:
+                errors.append({"line": line_no, "error": f"{d.year} 年編號 {row_id} 已存在"}); continue
+            taken.add((d.year, row_id))
+        valid.append((d.year, row, row_id))
+
+    next_ids, records = {}, []
+    for year, row, row_id in valid:
+        if not row_id:
+            if year not in next_ids:
+                in_file = [int(i) for y, i in taken if y == year and i.isdigit()]
+                next_ids[year] = max([core.next_id_for_year(snapshot, year)] + [i + 1 for i in in_file])
+            row['編號'] = next_ids[year]
+            next_ids[year] += 1
+        records.append(row)
+
+    result = {"valid": len(records), "invalid": len(errors), "errors": errors, "ids": [r['編號'] for r in records], "applied": False}
+    if args.apply and records:
+        success, msg = core.append_records(records)
+        result.update(applied=success, message=msg)
+        if not success: return emit(result, ok=False)
+    return emit(result)
+
+def cmd_enrich(args):
+    snapshot = load_snapshot()
+    report = core.bulk_enrich_tax_ids(snapshot.company_dict, snapshot.df_business, snapshot.tax_map, snapshot.rev_tax_map,
+                                      max_workers=args.workers, rate_per_sec=args.rate, base_url=args.base_url)
+    core.save_gcis_cache()
+    result = {"checked": len(report), "to_write": sum(1 for r in report if r["寫入"]), "report": report, "applied": False}
+    if args.apply:
+        success, msg = core.write_enrichment_to_sheet(report)
+        result.update(applied=success, message=msg)
+        if not success: return emit(result, ok=False)
+    return emit(result)
+
+def cmd_warm_cache(args):
+    result = {}
+    if not args.skip_fx:
+        result["fx"] = core.warm_fx_cache(args.currencies.split(","), args.days)
+    if not args.skip_gcis:
+        snapshot = load_snapshot()
+        report = core.bulk_enrich_tax_ids(snapshot.company_dict, snapshot.df_business, snapshot.tax_map, snapshot.rev_tax_map,
+                                          max_workers=args.workers, rate_per_sec=args.rate)
+        result["gcis_lookups"] = len(report)
+        result["gcis_cache_entries"] = core.save_gcis_cache()
+    return emit(result)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="雲端業務系統批次工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("sync", help="下載雲端資料並存一份本機備份")
+    p.add_argument("--out", default="backups")
+    p.add_argument("--format", choices=list(core.EXPORT_FORMATS), default="Parquet")
+    p.set_defaults(func=cmd_sync)
+
+    p = sub.add_parser("export", help="匯出紀錄與彙總")
+    p.add_argument("--format", choices=list(core.EXPORT_FORMATS), default="CSV")
+    p.add_argument("--year", type=int, help="只匯出指定年度 (預設為全部歷史資料)")
+    p.add_argument("--out", required=True)
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("import", help="從 CSV / Excel 批次匯入紀錄，未填編號者自動編號")
+    p.add_argument("file")
+    p.add_argument("--apply", action="store_true", help="實際寫入雲端 (預設只檢查)")
+    p.set_defaults(func=cmd_import)
+
+    for name, func, help_text in [("enrich", cmd_enrich, "統編批次查核"), ("warm-cache", cmd_warm_cache, "預熱匯率表與 GCIS 查詢快取")]:
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--workers", type=int, default=4)
+        p.add_argument("--rate", type=float, default=5, help="每秒最多查詢次數")
+        p.set_defaults(func=func)
+    sub.choices["enrich"].add_argument("--apply", action="store_true", help="將結果寫回統編表 (預設只產生報告)")
+    sub.choices["enrich"].add_argument("--base-url", default=None, help="GCIS API 位址 (可指向本機測試伺服器)")
+    sub.choices["warm-cache"].add_argument("--currencies", default=",".join(core.FX_CURRENCIES))
+    sub.choices["warm-cache"].add_argument("--days", type=int, default=30)
+    sub.choices["warm-cache"].add_argument("--skip-fx", action="store_true")
+    sub.choices["warm-cache"].add_argument("--skip-gcis", action="store_true")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try: return args.func(args)
+    except Exception as e: return emit({"command": args.command, "error": str(e)}, ok=False)
+
+if __name__ == "__main__":
+    sys.exit(main())
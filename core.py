@@ -0,0 +1,1123 @@
+"""
+業務系統的資料層：Google Sheets 讀寫、GCIS / 匯率查詢、資料快照與報表計算。
+不依賴 Streamlit，app.py (介面) 與 cli.py (排程批次) 共用。
+"""
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+import os
+import json
+import logging
+import re
+import importlib
+import tempfile
+import zipfile
+import requests
+import threading
+from types import MappingProxyType
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+# 診斷訊息一律走 logging (預設輸出到 stderr)，不能印到 stdout，以免混進 cli.py 的 JSON 輸出
+logger = logging.getLogger(__name__)
+
+# 重量級套件 (plotly / gspread / oauth2client / yfinance / pyarrow / openpyxl) 不在模組層匯入，
+# 於第一次用到時才以 importlib.import_module 載入，加快冷啟動
+
+# ==========================================
+# 📍 設定區
+# ==========================================
+SPREADSHEET_KEY = '1Q1-JbHje0E-8QB0pu83OHN8jCPY8We9l2j1_7eZ8yas'
+CACHE_DIR = os.environ.get("BUSINESS_APP_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+class SheetConnectionError(Exception):
+    """無法連線或授權 Google Sheets"""
+
+def _save_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# ==========================================
+# ☁️ Google Sheets 連線與工具函式
+# ==========================================
+SHEET_CLIENT_MAX_AGE = 45 * 60  # 授權 token 約一小時過期，提早重建
+LOCAL_KEY_FILES = [
+    os.environ.get("GCP_SERVICE_ACCOUNT_FILE", ""),
+    r'service_account.json',
+    r'C:\Users\User\Desktop\業務登記表\service_account.json',
+]
+
+# 同一個 process 共用一個已授權的 client (Streamlit rerun 不會重新匯入本模組)
+_client_state = {"client": None, "created": 0.0, "key_dict": None}
+_client_lock = threading.Lock()
+
+def set_service_account_info(key_dict):
+    """由呼叫端 (例如 app.py 讀取 st.secrets) 提供金鑰內容，優先於本機金鑰檔"""
+    with _client_lock: _client_state["key_dict"] = key_dict
+
+def build_google_sheet_client():
+    """建立已授權的 gspread client；找不到金鑰時拋出 FileNotFoundError"""
+    gspread = importlib.import_module("gspread")
+    ServiceAccountCredentials = importlib.import_module("oauth2client.service_account").ServiceAccountCredentials
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    key_dict = _client_state["key_dict"]
+    if key_dict is None and os.environ.get("GCP_SERVICE_ACCOUNT_JSON"):
+        key_dict = json.loads(os.environ["GCP_SERVICE_ACCOUNT_JSON"])
+    if key_dict is not None:
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(key_dict, scope)
+    else:
+        key_file = next((p for p in LOCAL_KEY_FILES if p and os.path.exists(p)), None)
+        if not key_file: raise FileNotFoundError("service_account.json")
+        creds = ServiceAccountCredentials.from_json_keyfile_name(key_file, scope)
+    return gspread.authorize(creds)
+
+def get_google_sheet_client():
+    """回傳共用的 client (同一個 process 只授權一次，過期才重建)；失敗時拋出 SheetConnectionError"""
+    with _client_lock:
+        if _client_state["client"] is not None and time.monotonic() - _client_state["created"] < SHEET_CLIENT_MAX_AGE:
+            return _client_state["client"]
+    for attempt in range(3):
+        try:
+            client = build_google_sheet_client()
+            with _client_lock: _client_state["client"], _client_state["created"] = client, time.monotonic()
+            return client
+        except FileNotFoundError:
+            raise SheetConnectionError("❌ 找不到金鑰檔案 (service_account.json)！")
+        except Exception as e:
+            if "503" in str(e): time.sleep(2); continue
+            raise SheetConnectionError(f"連線失敗: {e}")
+    raise SheetConnectionError("❌ Google 伺服器忙線中")
+
+def clean_headers(headers):
+    cleaned = []
+    seen = {}
+    for i, col in enumerate(headers):
+        c = str(col).strip()
+        if not c: c = f"未命名_{i}"
+        if c in seen: seen[c] += 1; c = f"{c}_{seen[c]}"
+        else: seen[c] = 0
+        cleaned.append(c)
+    return cleaned
+
+def parse_taiwan_date(date_str):
+    if pd.isna(date_str) or str(date_str).strip() == "": return pd.NaT
+    s = str(date_str).split(',')[0].strip().replace(".", "/")
+    try:
+        parts = s.split('/')
+        if len(parts) == 2:
+            this_year = datetime.now().year
+            return pd.to_datetime(f"{this_year}-{parts[0]}-{parts[1]}")
+        elif len(parts) == 3:
+            year_val = int(parts[0])
+            if year_val < 1911: year_val += 1911
+            return pd.to_datetime(f"{year_val}-{parts[1]}-{parts[2]}")
+        else: return pd.to_datetime(s)
+    except: return pd.NaT
+
+def parse_taiwan_date_series(series):
+    """parse_taiwan_date 的向量化版本：整欄一次解析 (民國年 / 月日 / 一般日期格式)，不逐列呼叫"""
+    s = series.astype(str).str.strip()
+    # 系統寫入的日期都是 YYYY-MM-DD，先用固定格式快速解析，其餘才走完整規則
+    result = pd.to_datetime(s, format="%Y-%m-%d", errors='coerce')
+    rest = result.isna() & (s != "") & (s.str.lower() != "nan")
+    if not rest.any(): return result
+
+    r = s[rest].str.replace(".", "/", regex=False)
+    parts = r.str.extract(r'^(\d{1,4})/(\d{1,2})(?:/(\d{1,2}))?$').apply(pd.to_numeric, errors='coerce')
+    two_parts = parts[2].isna()
+    year = parts[0].where(~two_parts, datetime.now().year)
+    year = year.where(two_parts | (year >= 1911), year + 1911)
+    parsed = pd.to_datetime(pd.DataFrame({
+        "year": year,
+        "month": parts[1].where(~two_parts, parts[0]),
+        "day": parts[2].where(~two_parts, parts[1]),
+    }), errors='coerce')
+
+    # 非 年/月/日 或 月/日 格式的其餘字串格式不一，逐一 (只解析不重複的值) 交給 parse_taiwan_date，
+    # 結果才不會因同一批的其他資料而不同
+    other = parts[1].isna()
+    if other.any():
+        uniques = r[other].unique()
+        lookup = pd.Series([parse_taiwan_date(v) for v in uniques], index=uniques, dtype="datetime64[ns]")
+        parsed[other] = r[other].map(lookup)
+    result[rest] = parsed
+    return result
+
+def to_amount_series(series):
+    return pd.to_numeric(series.astype(str).str.replace(',', '').replace('', '0'), errors='coerce').fillna(0)
+
+def get_worksheet_safe(sh, possible_names, index_fallback):
+    for name in possible_names:
+        try: return sh.worksheet(name)
+        except: pass
+    try: return sh.get_worksheet(index_fallback)
+    except: return None
+
+# ==========================================
+# 🌍 外部 API 查詢功能
+# ==========================================
+GCIS_API_BASE = os.environ.get("GCIS_API_BASE", "https://data.gcis.nat.gov.tw/od/data/api")
+GCIS_COMPANY_API = "9D17AE0D-09B5-4732-A8F4-81ADED04B679"   # 公司登記基本資料
+GCIS_BUSINESS_API = "426D5542-5F05-43EB-83F9-F1300F14E1F1"  # 商業登記基本資料
+GCIS_NAME_API = "6BBA2268-1367-4B42-9CCA-BC17499EBE8C"      # 公司名稱關鍵字查詢
+
+# 查詢快取 (跨 session 共用，查無資料也會記錄，避免重複打 API)；可存到 CACHE_DIR 供下次啟動或排程預熱使用
+# 每筆記錄查詢時間，過期後重查；查無資料的結果保留時間較短，以便新登記的公司能盡快查到
+GCIS_CACHE_FILE = os.path.join(CACHE_DIR, "gcis_cache.json")
+GCIS_CACHE_TTL = 7 * 24 * 3600
+GCIS_NEGATIVE_TTL = 6 * 3600
+GCIS_CACHE_MAX_ENTRIES = 20000
+_gcis_cache = OrderedDict()  # key -> (結果, 查詢時間)；超過上限時淘汰最久未用的項目
+_gcis_cache_lock = threading.Lock()
+_gcis_cache_loaded = False
+
+class RateLimiter:
+    """多執行緒共用的節流器，確保每秒請求數不超過 rate_per_sec"""
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec and rate_per_sec > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_s = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_s > 0: time.sleep(wait_s)
+
+def normalize_text(text): return str(text).replace('臺', '台').strip()
+
+def _gcis_query(api_id, filter_str, base_url=None, limiter=None):
+    """回傳 GCIS 查詢結果 list；查無資料回傳 []，連線失敗則拋出例外"""
+    if limiter: limiter.wait()
+    params = {"$format": "json", "$filter": filter_str}
+    response = requests.get(f"{base_url or GCIS_API_BASE}/{api_id}", params=params, timeout=5)
+    if response.status_code != 200: raise RuntimeError(f"HTTP {response.status_code}")
+    if not response.text.strip(): return []
+    data = response.json()
+    return data if isinstance(data, list) else []
+
+def _is_negative(value): return value is None or value == (None, None)
+
+def _gcis_fresh(value, fetched_at, now):
+    return now - fetched_at < (GCIS_NEGATIVE_TTL if _is_negative(value) else GCIS_CACHE_TTL)
+
+def _gcis_store(key, value, fetched_at):
+    """呼叫端需持有 _gcis_cache_lock"""
+    _gcis_cache[key] = (value, fetched_at)
+    _gcis_cache.move_to_end(key)
+    while len(_gcis_cache) > GCIS_CACHE_MAX_ENTRIES: _gcis_cache.popitem(last=False)
+
+def load_gcis_cache():
+    global _gcis_cache_loaded
+    with _gcis_cache_lock:
+        if _gcis_cache_loaded: return
+        _gcis_cache_loaded = True
+        try:
+            now = time.time()
+            with open(GCIS_CACHE_FILE, encoding='utf-8') as f:
+                for kind, base, query, value, fetched_at in json.load(f):
+                    value = tuple(value) if isinstance(value, list) else value
+                    if (kind, base, query) not in _gcis_cache and _gcis_fresh(value, fetched_at, now):
+                        _gcis_store((kind, base, query), value, fetched_at)
+        except FileNotFoundError: pass
+        except Exception as e: logger.warning("GCIS cache skipped: %s", e)
+
+def save_gcis_cache():
+    """將未過期的查詢結果存檔；回傳存檔筆數"""
+    now = time.time()
+    with _gcis_cache_lock:
+        entries = [[*key, value, fetched_at] for key, (value, fetched_at) in _gcis_cache.items() if _gcis_fresh(value, fetched_at, now)]
+    _save_json_atomic(GCIS_CACHE_FILE, entries)
+    return len(entries)
+
+def _gcis_cached(key, fetch, use_negative=True):
+    """use_negative=False 時忽略快取中的查無資料結果，一律重查"""
+    load_gcis_cache()
+    with _gcis_cache_lock:
+        hit = _gcis_cache.get(key)
+        if hit is not None and _gcis_fresh(*hit, time.time()) and (use_negative or not _is_negative(hit[0])):
+            _gcis_cache.move_to_end(key)
+            return hit[0]
+    result = fetch()
+    with _gcis_cache_lock: _gcis_store(key, result, time.time())
+    return result
+
+def lookup_company_name(tax_id, base_url=None, limiter=None, use_negative=True):
+    """以統編查詢登記名稱 (先查公司、再查商號)；查無資料回傳 None"""
+    def fetch():
+        data = _gcis_query(GCIS_COMPANY_API, f"Business_Accounting_NO eq {tax_id}", base_url, limiter)
+        if data and data[0].get("Company_Name"): return data[0]["Company_Name"]
+        data = _gcis_query(GCIS_BUSINESS_API, f"Business_Accounting_NO eq {tax_id}", base_url, limiter)
+        if data and data[0].get("Business_Name"): return data[0]["Business_Name"]
+        return None
+    return _gcis_cached(("tax", base_url or GCIS_API_BASE, str(tax_id)), fetch, use_negative)
+
+def lookup_tax_id_by_name(company_name, base_url=None, limiter=None):
+    """以公司名稱查詢統編；完全相符優先，否則僅在唯一結果時採用。回傳 (統編, 登記名稱)"""
+    def fetch():
+        data = _gcis_query(GCIS_NAME_API, f"Company_Name like {company_name} and Company_Status eq 01", base_url, limiter)
+        target = normalize_text(company_name)
+        for row in data:
+            if normalize_text(row.get("Company_Name", "")) == target:
+                return row.get("Business_Accounting_NO"), row.get("Company_Name")
+        if len(data) == 1: return data[0].get("Business_Accounting_NO"), data[0].get("Company_Name")
+        return None, None
+    return _gcis_cached(("name", base_url or GCIS_API_BASE, normalize_text(company_name)), fetch)
+
+def search_gov_company_data(tax_id):
+    # 使用者手動查詢時不採用快取的查無資料結果，剛登記的公司才查得到
+    try: return lookup_company_name(tax_id, use_negative=False)
+    except Exception as e: logger.warning("API Error: %s", e)
+    return None
+
+def auto_classify_category(company_name, existing_categories):
+    if not company_name: return None
+    for cat in existing_categories:
+        if len(cat) >= 2 and cat in company_name: return cat
+            
+    keyword_map = {
+        "營造": "工程", "建設": "工程", "工程": "工程", "土木": "工程",
+        "機電": "機械設備", "機械": "機械設備", "精密": "機械設備", "工業": "機械設備", "設備": "機械設備",
+        "電力": "能源電力", "發電": "能源電力", "能源": "能源電力", "汽電": "能源電力",
+        "客運": "交通運輸", "海運": "交通運輸", "物流": "交通運輸", "捷運": "交通運輸", "鐵路": "交通運輸", "航運": "交通運輸", "車輛": "交通運輸", "汽車": "交通運輸",
+        "科技": "電子家電", "電子": "電子家電", "半導體": "電子家電", "光電": "電子家電", "電路": "電子家電", "資訊": "軟體科技", "軟體": "軟體科技", "數位": "軟體科技",
+        "實業": "五金", "五金": "五金", "金屬": "五金",
+        "貿易": "貿易", "企業": "貿易", "國際": "貿易",
+        "塑膠": "塑膠化工", "化學": "塑膠化工", "化工": "塑膠化工", "材料": "建材", "建材": "建材"
+    }
+    
+    for key, val in keyword_map.items():
+        if key in company_name:
+            if val in existing_categories: return val
+    return None
+
+# ==========================================
+# 🧾 統編批次查核
+# ==========================================
+def bulk_enrich_tax_ids(company_dict, df_business, tax_map, rev_tax_map, max_workers=4, rate_per_sec=5, base_url=None):
+    """
+    批次比對公司名單、業務紀錄與統編表，並行查詢 GCIS。
+    回傳報告 list，每筆含：動作 (核對/補統編/補名稱)、類別、客戶名稱、統一編號、登記名稱、狀態、寫入。
+    "寫入" 為 True 的項目才會由 write_enrichment_to_sheet 寫回統編表。
+    """
+    existing_cats = list(company_dict.keys())
+    limiter = RateLimiter(rate_per_sec)
+    tasks = []
+
+    # 1. 統編表既有資料：核對登記名稱，並補上空白類別
+    for tax_id, info in rev_tax_map.items():
+        tasks.append(("核對", info.get("cat", ""), info.get("name", ""), tax_id))
+
+    # 2. 公司名單中沒有統編的客戶：以名稱反查統編
+    seen_names = set(tax_map.keys())
+    for cat, clients in company_dict.items():
+        for client in clients:
+            if client and client not in seen_names:
+                seen_names.add(client)
+                tasks.append(("補統編", cat, client, ""))
+
+    # 3. 業務紀錄中出現、但統編表沒有的統編
+    if not df_business.empty and '統一編號' in df_business.columns:
+        cols = [c for c in ['客戶類別', '客戶名稱', '統一編號'] if c in df_business.columns]
+        df_tax = df_business[cols].astype(str).apply(lambda col: col.str.strip())
+        df_tax = df_tax[(df_tax['統一編號'] != '') & (~df_tax['統一編號'].isin(list(rev_tax_map)))]
+        for row in df_tax.drop_duplicates(subset=['統一編號']).to_dict('records'):
+            tasks.append(("補名稱", row.get('客戶類別', ''), row.get('客戶名稱', ''), row['統一編號']))
+
+    def run_task(task):
+        action, cat, name, tax_id = task
+        item = {"動作": action, "類別": cat, "客戶名稱": name, "統一編號": tax_id, "登記名稱": "", "狀態": "", "寫入": False}
+        try:
+            if action == "補統編":
+                found_tax, gov_name = lookup_tax_id_by_name(name, base_url, limiter)
+                if not found_tax: item["狀態"] = "❌ 查無資料"; return item
+                item["統一編號"], item["登記名稱"] = found_tax, gov_name
+                existing = rev_tax_map.get(found_tax)
+                if existing is None:
+                    item["狀態"] = "🆕 新增統編"; item["寫入"] = True
+                else:
+                    # 統編表已有此統編 (可能登記在另一個名稱下)：不新增，只在原本類別空白時補上
+                    item["狀態"] = f"📋 已在統編表: {existing.get('name', '')}"
+                    item["寫入"] = bool(cat) and not existing.get("cat")
+                return item
+
+            gov_name = lookup_company_name(tax_id, base_url, limiter)
+            if not gov_name: item["狀態"] = "❌ 查無資料"; return item
+            item["登記名稱"] = gov_name
+            if not cat: item["類別"] = auto_classify_category(gov_name, existing_cats) or ""
+
+            if action == "補名稱":
+                if not name: item["客戶名稱"] = gov_name
+                item["狀態"] = "🆕 新增統編"; item["寫入"] = True
+            elif normalize_text(name) != normalize_text(gov_name) and normalize_text(name) not in normalize_text(gov_name):
+                item["狀態"] = "⚠️ 名稱不符"
+            else:
+                item["狀態"] = "✅ 相符"
+                if not cat and item["類別"]: item["狀態"] = "🏷️ 補上類別"; item["寫入"] = True
+        except Exception as e:
+            item["狀態"] = f"⚠️ 查詢失敗: {e}"
+        return item
+
+    if not tasks: return []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run_task, tasks))
+
+def load_data_from_gsheet():
+    """讀取公司名單、業務表單與統編表；回傳 (company_dict, df_business, tax_map, rev_tax_map)，失敗時拋出例外"""
+    for attempt in range(3):
+        try:
+            client = get_google_sheet_client()
+            sh = client.open_by_key(SPREADSHEET_KEY)
+            
+            ws_c = get_worksheet_safe(sh, ["公司名稱", "Company List"], 1)
+            cd = {}
+            if ws_c:
+                data = ws_c.get_all_values()
+                if len(data) > 0:
+                    headers = [str(h).strip() for h in data[0]]
+                    max_rows = len(data)
+                    for col_idx, category in enumerate(headers):
+                        if not category: continue 
+                        clients = []
+                        for row_idx in range(1, max_rows):
+                            if col_idx < len(data[row_idx]):
+                                val = str(data[row_idx][col_idx]).strip()
+                                if val: clients.append(val)
+                        cd[category] = clients
+            
+            ws_f = get_worksheet_safe(sh, ["業務表單", "業務資料表", "工作表1", "Sheet1"], 0)
+            df_b = pd.DataFrame()
+            if ws_f:
+                all_values = ws_f.get_all_values()
+                header_idx = -1
+                for i, row in enumerate(all_values[:10]):
+                    r_str = [str(r).strip() for r in row]
+                    if "編號" in r_str and "日期" in r_str: header_idx = i; break
+                
+                if header_idx != -1 and len(all_values) > header_idx + 1:
+                    headers = clean_headers(all_values[header_idx])
+                    df_b = pd.DataFrame(all_values[header_idx+1:], columns=headers)
+                    if '編號' in df_b.columns: df_b = df_b[df_b['編號'].astype(str).str.strip() != '']
+
+            ws_t = get_worksheet_safe(sh, ["統一編號", "Tax ID"], 2)
+            tax_map = {}
+            rev_tax_map = {}
+            
+            if ws_t:
+                t_data = ws_t.get_all_values()
+                if len(t_data) > 1:
+                    for row in t_data[1:]:
+                        if len(row) >= 3:
+                            c_cat = str(row[0]).strip()
+                            c_name = str(row[1]).strip()
+                            c_tax = str(row[2]).strip()
+                            if c_name and c_tax:
+                                tax_map[c_name] = c_tax
+                                rev_tax_map[c_tax] = {"name": c_name, "cat": c_cat}
+
+            return cd, df_b, tax_map, rev_tax_map
+        except Exception as e:
+            if "503" in str(e): time.sleep(2); continue
+            raise
+    raise SheetConnectionError("❌ Google 伺服器忙線中")
+
+# ==========================================
+# 🗂️ 共用資料快照
+# ==========================================
+# 每個 process 只保留一份唯讀快照，所有 session 直接共用同一個物件 (不再每次 rerun 反序列化複本)。
+# 快照內容一律視為唯讀；各 session 的臨時新增透過 CompanyDirectoryView 疊加，不修改快照本身。
+SNAPSHOT_TTL = 60
+
+def make_row_keys(df):
+    """
+    以 (年份, 編號) 作為每列的識別鍵，例如 "2024/15"；編號每年重新起算，年份與自動編號規則相同 (見 _record_years)。
+    無法判斷年份的列只用編號；仍然重複的鍵依出現順序加上 #1、#2…
+    """
+    if '編號' not in df.columns: return pd.Index(df.index.astype(str), name="row_key")
+    ids = df['編號'].astype(str).str.strip()
+    year = _record_years(df)
+    ids = ids.where(year.isna(), year.astype("Int64").astype(str) + "/" + ids)
+    dup = ids.duplicated().to_numpy()
+    if not dup.any(): return pd.Index(ids, name="row_key")
+    codes, _ = pd.factorize(ids)
+    occurrence = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+    keys = ids.to_numpy(dtype=object).copy()
+    keys[dup] = ids[dup] + "#" + pd.Series(occurrence[dup], index=ids.index[dup]).astype(str)
+    return pd.Index(keys, name="row_key")
+
+class SnapshotDelta:
+    """兩個快照之間的差異 (以 row_key 表示)"""
+    __slots__ = ("inserted", "updated", "deleted")
+
+    def __init__(self, inserted, updated, deleted):
+        self.inserted, self.updated, self.deleted = inserted, updated, deleted
+
+    @property
+    def changed(self): return self.inserted.union(self.updated)
+
+    @property
+    def removed(self): return self.deleted.union(self.updated)
+
+    def __len__(self): return len(self.inserted) + len(self.updated) + len(self.deleted)
+
+def diff_snapshots(old, new):
+    """比對兩個快照的逐列雜湊；欄位不同時回傳 None (需完整重建)"""
+    if old is None or list(old.df_business.columns) != list(new.df_business.columns): return None
+    old_h, new_h = old.row_hashes, new.row_hashes
+    common = new_h.index.intersection(old_h.index)
+    updated = common[new_h.loc[common].to_numpy() != old_h.loc[common].to_numpy()]
+    return SnapshotDelta(new_h.index.difference(old_h.index), updated, old_h.index.difference(new_h.index))
+
+class DataSnapshot:
+    """
+    某一版本的雲端資料；derived 用來存放以此版本計算出的衍生結果 (如戰情室彙總)。
+    df_business 以 row_key 為索引，row_hashes 為每列內容的雜湊，用來和上一版比對出增刪改。
+    """
+    __slots__ = ("version", "company_dict", "df_business", "tax_map", "rev_tax_map", "row_hashes", "delta",
+                 "derived", "_derived_lock", "_previous_derived")
+
+    def __init__(self, version, company_dict, df_business, tax_map, rev_tax_map, previous=None):
+        self.version = version
+        self.company_dict = MappingProxyType({cat: tuple(clients) for cat, clients in company_dict.items()})
+        self.df_business = df_business.set_axis(make_row_keys(df_business))
+        self.tax_map = MappingProxyType(tax_map)
+        self.rev_tax_map = MappingProxyType({k: MappingProxyType(v) for k, v in rev_tax_map.items()})
+        self.row_hashes = pd.util.hash_pandas_object(self.df_business, index=False)
+        self.delta = diff_snapshots(previous, self)
+        self.derived = {}
+        self._derived_lock = threading.RLock()
+        self._previous_derived = previous.derived if previous is not None and self.delta is not None else {}
+
+    def get_derived(self, key, builder):
+        """同一版本只計算一次，之後所有 session 共用結果"""
+        with self._derived_lock:
+            if key not in self.derived: self.derived[key] = builder(self)
+            return self.derived[key]
+
+    def get_rows(self, name):
+        """
+        逐列衍生表 (見 ROW_BUILDERS)。上一版已算過時，只重算新增 / 修改的列並移除刪除的列，
+        其餘沿用上一版結果；否則完整建立。
+        """
+        def build(snapshot):
+            builder, keep_order = ROW_BUILDERS[name]
+            prev = self._previous_derived.get(("rows", name))
+            if prev is None: return builder(self.df_business)
+            delta = self.delta
+            kept = prev[~prev.index.isin(delta.removed)] if len(delta) else prev
+            added = builder(self.df_business.loc[delta.changed]) if len(delta.changed) else kept.iloc[0:0]
+            # 只合併非空的部分，避免空結果的欄位型別 (object) 污染合併後的型別
+            parts = [part for part in (kept, added) if len(part)]
+            rows = pd.concat(parts) if len(parts) == 2 else (parts[0] if parts else added)
+            # 內容沒變、只有列順序改變時也要重新排列
+            if keep_order and not rows.index.equals(self.df_business.index): rows = rows.reindex(self.df_business.index)
+            return rows
+        return self.get_derived(("rows", name), build)
+
+    def carry_forward(self):
+        """將上一版已建立的逐列衍生表套用差異後更新到本版，然後釋放上一版的參照"""
+        for key in list(self._previous_derived):
+            if isinstance(key, tuple) and key[0] == "rows": self.get_rows(key[1])
+        self._previous_derived = {}
+
+class CompanyDirectoryView(Mapping):
+    """共用公司名單 + 本 session 臨時新增 (temp_new_data) 的疊加視圖；臨時新增的公司排在最前面"""
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+
+    def __getitem__(self, cat):
+        base_clients = self.base.get(cat)
+        extra = self.overlay.get(cat)
+        if base_clients is None and extra is None: raise KeyError(cat)
+        base_clients = base_clients or ()
+        added = [c for c in reversed(extra or []) if c not in base_clients]
+        return added + list(base_clients)
+
+    def __iter__(self):
+        yield from self.base
+        for cat in self.overlay:
+            if cat not in self.base: yield cat
+
+    def __len__(self):
+        return len(self.base) + sum(1 for cat in self.overlay if cat not in self.base)
+
+_snapshot_store = {"snapshot": None, "loaded_at": 0.0, "version": 0}
+_snapshot_lock = threading.Lock()
+
+def get_data_snapshot():
+    """取得目前的共用快照；過期時由第一個進來的 session 重新載入，其他 session 等待同一份結果"""
+    with _snapshot_lock:
+        if _snapshot_store["snapshot"] is None or time.monotonic() - _snapshot_store["loaded_at"] > SNAPSHOT_TTL:
+            cd, df_b, tax_map, rev_tax_map = load_data_from_gsheet()
+            _snapshot_store["version"] += 1
+            snapshot = DataSnapshot(_snapshot_store["version"], cd, df_b, tax_map, rev_tax_map, previous=_snapshot_store["snapshot"])
+            snapshot.carry_forward()
+            _snapshot_store["snapshot"] = snapshot
+            _snapshot_store["loaded_at"] = time.monotonic()
+        return _snapshot_store["snapshot"]
+
+def invalidate_data_snapshot():
+    with _snapshot_lock: _snapshot_store["loaded_at"] = 0.0
+
+def _price_col(df): return next((c for c in df.columns if '價格' in c or '金額' in c), None)
+
+def _date_col(df): return next((c for c in df.columns if '日期' in c), None)
+
+def _build_typed_rows(df):
+    """金額轉數值、日期解析；無日期欄位時不含 parsed_date"""
+    df_clean = df.copy()
+    price_col = _price_col(df_clean)
+    if price_col: df_clean[price_col] = to_amount_series(df_clean[price_col])
+
+    date_col = _date_col(df_clean)
+    if date_col: df_clean['parsed_date'] = parse_taiwan_date_series(df_clean[date_col].astype(str).str.split(',').str[0])
+    return df_clean
+
+def build_typed_frame(snapshot):
+    """所有紀錄的型別化資料；回傳 (df_typed, price_col)"""
+    return snapshot.get_rows("typed"), _price_col(snapshot.df_business)
+
+def build_dashboard_frame(snapshot):
+    """戰情室用資料 (僅保留日期有效的紀錄)；回傳 (df_valid, price_col)，無日期欄位時 df_valid 為 None"""
+    df_typed, price_col = snapshot.get_derived("typed_frame", build_typed_frame)
+    if 'parsed_date' not in df_typed.columns: return None, price_col
+    df_valid = df_typed.dropna(subset=['parsed_date'])
+    df_valid = df_valid.assign(Year=df_valid['parsed_date'].dt.year)
+    return df_valid, price_col
+
+AGING_BINS = [-float("inf"), 30, 60, 90, float("inf")]
+AGING_LABELS = ["0-30天", "31-60天", "61-90天", "90天以上"]
+PAIR_COLUMNS = ["seq", "date_inv", "date_pay", "金額", "編號", "客戶名稱", "客戶類別", "收款天數"]
+
+def _explode_date_list(df, col):
+    """將逗號串接的日期欄位展開成 (row, date, seq)；seq 為同一筆紀錄內依日期排序的序號"""
+    s = df[col].astype(str).str.split(',').explode().str.strip()
+    s = s[(s != "") & (s.str.lower() != "nan")]
+    # 解析出的時間單位會隨資料而不同 (空欄位時為 s)，統一為 ns，增量更新時合併的各批型別才一致
+    out = pd.DataFrame({"row": s.index, "date": parse_taiwan_date_series(s).astype("datetime64[ns]").values}).dropna(subset=["date"])
+    out = out.sort_values(["row", "date"], kind="stable")
+    out["seq"] = out.groupby("row").cumcount()
+    return out
+
+def _build_invoice_pairs(df):
+    """
+    每張發票一列 (索引為 row_key)：第 n 張發票對應第 n 筆收款，
+    金額以完稅價格平均分攤至該筆紀錄的每張發票。
+    """
+    empty = pd.DataFrame({
+        "seq": pd.Series(dtype="int64"), "date_inv": pd.Series(dtype="datetime64[ns]"), "date_pay": pd.Series(dtype="datetime64[ns]"),
+        "金額": pd.Series(dtype=float), "編號": pd.Series(dtype=object), "客戶名稱": pd.Series(dtype=object),
+        "客戶類別": pd.Series(dtype=object), "收款天數": pd.Series(dtype=float),
+    }, index=pd.Index([], dtype=object, name="row_key"))
+    if df.empty or '發票日期' not in df.columns: return empty
+    inv = _explode_date_list(df, '發票日期')
+    if inv.empty: return empty
+    pay = _explode_date_list(df, '收款日期') if '收款日期' in df.columns else inv.iloc[0:0]
+    pairs = inv.merge(pay, on=["row", "seq"], how="left", suffixes=("_inv", "_pay"))
+
+    price_col = _price_col(df)
+    amounts = to_amount_series(df[price_col]) if price_col else pd.Series(0, index=df.index)
+    n_inv = pairs.groupby("row")["seq"].transform("size")
+    pairs["金額"] = amounts.reindex(pairs["row"]).to_numpy() / n_inv.to_numpy()
+    for col in ['編號', '客戶名稱', '客戶類別']:
+        pairs[col] = df[col].reindex(pairs["row"]).to_numpy() if col in df.columns else ""
+    pairs["收款天數"] = (pairs["date_pay"] - pairs["date_inv"]).dt.days.astype(float)
+    return pairs.set_index("row").rename_axis("row_key")[PAIR_COLUMNS]
+
+def build_receivables_report(snapshot):
+    """應收帳款與帳齡分析 (同一資料版本只計算一次；發票展開的部分依差異增量更新)"""
+    pairs = snapshot.get_rows("invoice_pairs")
+    if pairs.empty: return None
+
+    today = pd.Timestamp.today().normalize()
+    open_inv = pairs[pairs["date_pay"].isna()].copy()
+    open_inv["帳齡天數"] = (today - open_inv["date_inv"]).dt.days
+    open_inv["帳齡"] = pd.cut(open_inv["帳齡天數"], bins=AGING_BINS, labels=AGING_LABELS)
+
+    aging = open_inv.pivot_table(index="客戶名稱", columns="帳齡", values="金額", aggfunc="sum", fill_value=0, observed=False)
+    aging = aging.reindex(columns=AGING_LABELS, fill_value=0)
+    aging.columns = aging.columns.astype(str)
+    aging.columns.name = None
+    aging["未收總額"] = aging.sum(axis=1)
+    aging["未收張數"] = open_inv.groupby("客戶名稱").size().reindex(aging.index, fill_value=0)
+    aging = aging.sort_values("未收總額", ascending=False).reset_index()
+
+    paid_days = pairs["收款天數"].dropna()
+    open_list = open_inv.rename(columns={"date_inv": "發票日期"})[['編號', '客戶類別', '客戶名稱', '發票日期', '金額', '帳齡天數', '帳齡']]
+    return {
+        "aging": aging,
+        "open_invoices": open_list.sort_values("帳齡天數", ascending=False),
+        "days_to_pay": paid_days,
+        "outstanding_total": float(open_inv["金額"].sum()),
+        "outstanding_count": int(len(open_inv)),
+        "avg_days_to_pay": float(paid_days.mean()) if len(paid_days) else None,
+        "median_days_to_pay": float(paid_days.median()) if len(paid_days) else None,
+    }
+
+def _record_years(df):
+    """每列日期的西元年 (僅認 年/月/日 格式的日期，與自動編號規則一致)；無法判斷時為 NaN"""
+    date_col = _date_col(df)
+    if not date_col: return pd.Series(np.nan, index=df.index)
+    # 同一天的紀錄很多，只解析不重複的日期字串
+    codes, uniques = pd.factorize(df[date_col].astype(str))
+    s = pd.Series(uniques).str.strip().str.replace(".", "/", regex=False).str.replace("-", "/", regex=False)
+    parts = s.str.split('/')
+    year = pd.to_numeric(parts.str[0].where(parts.str.len() == 3), errors='coerce')
+    year = year.where(year >= 1911, year + 1911).to_numpy()
+    return pd.Series(year.take(codes) if len(year) else np.full(len(codes), np.nan), index=df.index)
+
+def _build_id_rows(df):
+    """每列的數字編號與年份"""
+    if df.empty or not _date_col(df) or '編號' not in df.columns:
+        return pd.DataFrame({"id_num": pd.Series(dtype=float), "year": pd.Series(dtype=float)}, index=df.index[:0])
+    return pd.DataFrame({"id_num": pd.to_numeric(df['編號'], errors='coerce'), "year": _record_years(df)}, index=df.index)
+
+def next_id_for_year(snapshot, target_year):
+    ids = snapshot.get_rows("ids")
+    max_id = ids.loc[ids["year"] == target_year, "id_num"].max()
+    return 1 if pd.isna(max_id) else int(max_id) + 1
+
+# 逐列衍生表：名稱 -> (由部分 df_business 建立結果的函式, 是否依 df_business 的列順序排列)
+# 結果必須以 row_key 為索引，才能在資料更新時只重算有變動的列
+ROW_BUILDERS = {
+    "typed": (_build_typed_rows, True),
+    "invoice_pairs": (_build_invoice_pairs, False),
+    "ids": (_build_id_rows, True),
+}
+
+# ==========================================
+# 📤 資料匯出
+# ==========================================
+# 匯出時依記憶體預算分批寫檔，不另外建立整份 DataFrame 的複本
+EXPORT_MEMORY_BUDGET = 32 * 1024 * 1024  # 每批資料約佔用的位元組上限
+EXPORT_FORMATS = {"CSV": ".zip", "Excel": ".xlsx", "Parquet": ".zip"}
+EXPORT_HIDDEN_COLS = ['Year', 'parsed_date']
+
+def export_chunk_rows(df, budget=EXPORT_MEMORY_BUDGET):
+    """以前 1000 筆估算每列大小，換算出每批可處理的列數"""
+    if df.empty: return 1
+    sample = df.iloc[:1000]
+    row_bytes = max(1, int(sample.memory_usage(index=False, deep=True).sum() / len(sample)))
+    return max(100, budget // row_bytes)
+
+def iter_export_chunks(df, columns, budget=EXPORT_MEMORY_BUDGET):
+    step = export_chunk_rows(df, budget)
+    for start in range(0, len(df), step):
+        yield df.iloc[start:start + step][columns]
+
+def build_export_aggregates(df, price_col):
+    """月彙總與類別彙總 (營業額、案件數)"""
+    aggs = {}
+    if price_col is None: return aggs
+    if 'parsed_date' in df.columns:
+        month = df['parsed_date'].dt.strftime('%Y-%m')
+        aggs["月彙總"] = df.groupby(month)[price_col].agg(['sum', 'count']).rename_axis('月份').rename(columns={'sum': '營業額', 'count': '案件數'}).reset_index()
+    cat_col = next((c for c in df.columns if '類別' in c), None)
+    if cat_col:
+        aggs["類別彙總"] = df.groupby(cat_col)[price_col].agg(['sum', 'count']).rename(columns={'sum': '營業額', 'count': '案件數'}).sort_values('營業額', ascending=False).reset_index()
+    return aggs
+
+def _write_csv(df, columns, path, budget):
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        df.iloc[:0][columns].to_csv(f, index=False)
+        for chunk in iter_export_chunks(df, columns, budget): chunk.to_csv(f, index=False, header=False)
+
+def _write_parquet(df, columns, path, budget):
+    pa = importlib.import_module("pyarrow")
+    pq = importlib.import_module("pyarrow.parquet")
+    # 文字欄位固定為 string，避免某一批全為空值時推斷出不同的型別
+    schema = pa.Schema.from_pandas(df.iloc[:1][columns], preserve_index=False)
+    schema = pa.schema([pa.field(f.name, pa.string()) if df[f.name].dtype == object else f for f in schema])
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_export_chunks(df, columns, budget):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+def _write_xlsx(df, columns, aggregates, path, budget):
+    openpyxl = importlib.import_module("openpyxl")
+    wb = openpyxl.Workbook(write_only=True)
+    sheets = [("業務資料", df, columns)] + [(name, agg, list(agg.columns)) for name, agg in aggregates.items()]
+    for sheet_name, data, cols in sheets:
+        ws = wb.create_sheet(sheet_name)
+        ws.append(cols)
+        for chunk in iter_export_chunks(data, cols, budget):
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for row in chunk.itertuples(index=False, name=None): ws.append(list(row))
+    wb.save(path)
+
+def export_dataset(df, price_col, fmt, dest_path, budget=EXPORT_MEMORY_BUDGET):
+    """
+    將紀錄與彙總寫入 dest_path。
+    Excel 為單一活頁簿 (業務資料 / 月彙總 / 類別彙總)；CSV 與 Parquet 則打包成 zip，每張表一個檔案。
+    """
+    columns = [c for c in df.columns if c not in EXPORT_HIDDEN_COLS]
+    aggregates = build_export_aggregates(df, price_col)
+    if fmt == "Excel":
+        _write_xlsx(df, columns, aggregates, dest_path, budget)
+        return dest_path
+
+    ext = ".csv" if fmt == "CSV" else ".parquet"
+    writer = _write_csv if fmt == "CSV" else _write_parquet
+    with tempfile.TemporaryDirectory() as tmp_dir, zipfile.ZipFile(dest_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data, cols in [("業務資料", df, columns)] + [(n, a, list(a.columns)) for n, a in aggregates.items()]:
+            part = os.path.join(tmp_dir, name + ext)
+            writer(data, cols, part, budget)
+            zf.write(part, arcname=name + ext)
+            os.remove(part)
+    return dest_path
+
+# ==========================================
+# 🛠️ 資料寫入邏輯
+# ==========================================
+def update_company_category_in_sheet(client_name, new_category):
+    try:
+        client = get_google_sheet_client()
+        sh = client.open_by_key(SPREADSHEET_KEY)
+        ws = get_worksheet_safe(sh, ["公司名稱"], 1)
+        if not ws: return False
+        
+        all_cols = ws.get_all_values()
+        if not all_cols: return False
+        
+        headers = [h.strip() for h in all_cols[0]]
+        if new_category in headers: new_col_idx = headers.index(new_category) + 1
+        else: new_col_idx = len(headers) + 1; ws.update_cell(1, new_col_idx, new_category); headers.append(new_category)
+
+        found_row, found_col = None, None
+        for c_idx, col_name in enumerate(headers):
+            col_vals = [row[c_idx] for row in all_cols if len(row) > c_idx]
+            if client_name in col_vals:
+                r_idx = col_vals.index(client_name); found_row = r_idx + 1; found_col = c_idx + 1; break
+        
+        if not found_row:
+            new_col_values = ws.col_values(new_col_idx)
+            next_row = len(new_col_values) + 1
+            ws.update_cell(next_row, new_col_idx, client_name)
+        return True
+    except: return False
+
+def update_tax_id_in_sheet(client_cat, client_name, tax_id):
+    if not client_name or not tax_id: return
+    try:
+        client = get_google_sheet_client()
+        sh = client.open_by_key(SPREADSHEET_KEY)
+        ws = get_worksheet_safe(sh, ["統一編號"], 2)
+        if not ws: return
+
+        cell = None
+        try: cell = ws.find(client_name, in_column=2)
+        except: pass
+
+        if cell: 
+            ws.update_cell(cell.row, 3, str(tax_id))
+            if client_cat: ws.update_cell(cell.row, 1, client_cat)
+        else: 
+            ws.append_row([client_cat, client_name, str(tax_id)])
+    except: pass
+
+def write_enrichment_to_sheet(report):
+    """
+    將批次查核結果一次寫回統編表：新統編用 append_rows，補類別用 batch_update。
+    同一個新統編只新增一列；對應到不同客戶名稱的統編不寫入，改列在回傳訊息中。
+    """
+    to_write = [r for r in report if r.get("寫入")]
+    if not to_write: return True, "沒有需要寫入的資料"
+    try:
+        client = get_google_sheet_client()
+        sh = client.open_by_key(SPREADSHEET_KEY)
+        ws = get_worksheet_safe(sh, ["統一編號"], 2)
+        if not ws: return False, "找不到統一編號工作表"
+
+        row_by_tax, cat_by_row = {}, {}
+        for r_idx, row in enumerate(ws.get_all_values(), start=1):
+            if len(row) >= 3 and str(row[2]).strip():
+                row_by_tax[str(row[2]).strip()] = r_idx
+                cat_by_row[r_idx] = str(row[0]).strip()
+
+        pending, cat_updates = {}, {}
+        for r in to_write:
+            tax_id = str(r["統一編號"]).strip()
+            if tax_id in row_by_tax:
+                # 只補空白的類別，不覆蓋統編表上既有的類別
+                row = row_by_tax[tax_id]
+                if r["類別"] and not cat_by_row[row]: cat_updates.setdefault(row, r["類別"])
+            else:
+                pending.setdefault(tax_id, []).append(r)
+
+        new_rows, conflicts = [], []
+        for tax_id, items in pending.items():
+            names = list(dict.fromkeys(normalize_text(r["客戶名稱"]) for r in items))
+            if len(names) > 1: conflicts.append(f"{tax_id} ({' / '.join(names)})"); continue
+            cat = next((r["類別"] for r in items if r["類別"]), "")
+            new_rows.append([cat, items[0]["客戶名稱"], tax_id])
+
+        if cat_updates: ws.batch_update([{"range": f"A{row}", "values": [[cat]]} for row, cat in cat_updates.items()])
+        if new_rows: ws.append_rows(new_rows, value_input_option='RAW')
+        msg = f"新增 {len(new_rows)} 筆統編、補上 {len(cat_updates)} 筆類別"
+        if conflicts: msg += f"；{len(conflicts)} 筆統編對應到不同名稱，未寫入: {', '.join(conflicts)}"
+        return True, msg
+    except Exception as e:
+        return False, f"寫入失敗: {e}"
+
+def _ensure_header_columns(ws, header_row, headers, names):
+    """標題列缺少 names 中的欄位時，接在最後一個非空白標題之後新增；回傳更新後的標題列"""
+    headers = list(headers)
+    for name in names:
+        if name in [str(h).strip() for h in headers]: continue
+        next_idx = max((i for i, h in enumerate(headers) if str(h).strip()), default=-1) + 1
+        ws.update_cell(header_row, next_idx + 1, name)
+        if next_idx < len(headers): headers[next_idx] = name
+        else: headers.append(name)
+    return headers
+
+def smart_save_record(data_dict, is_update=False):
+    for attempt in range(3):
+        try:
+            client = get_google_sheet_client()
+            sh = client.open_by_key(SPREADSHEET_KEY)
+            ws = get_worksheet_safe(sh, ["業務表單", "業務資料表", "Sheet1"], 0)
+            
+            all_values = ws.get_all_values()
+            headers = []
+            for i, row in enumerate(all_values[:10]):
+                r_str = [str(r).strip() for r in row]
+                if "編號" in r_str and "日期" in r_str: headers = row; break
+            if not headers: return False, "找不到標題列"
+            headers = _ensure_header_columns(ws, i + 1, headers, [c for c in FX_FIELD_COLUMNS if c in data_dict])
+
+            row_to_write = [""] * len(headers)
+            for col_name, value in data_dict.items():
+                try:
+                    idx = next(i for i, h in enumerate(headers) if str(h).strip() == col_name)
+                    row_to_write[idx] = str(value)
+                except StopIteration: pass
+
+            target_id = str(data_dict.get("編號"))
+            if is_update:
+                try:
+                    id_col_idx = headers.index("編號")
+                    id_list = ws.col_values(id_col_idx + 1)
+                    try:
+                        row_index = id_list.index(target_id) + 1
+                        ws.update(f"A{row_index}", [row_to_write], value_input_option='USER_ENTERED')
+                        return True, f"編號 {target_id} 更新成功"
+                    except ValueError: return False, "找不到原始編號"
+                except Exception as ex: return False, str(ex)
+            else:
+                ws.append_row(row_to_write, value_input_option='USER_ENTERED')
+                return True, f"編號 {target_id} 新增成功"
+        except Exception as e:
+            if "503" in str(e): time.sleep(2); continue
+            return False, f"寫入失敗: {e}"
+    return False, "連線逾時"
+
+def append_records(records):
+    """批次新增多筆紀錄 (一次 append_rows)；records 為 {欄位: 值} 的 list"""
+    if not records: return True, "沒有需要新增的資料"
+    for attempt in range(3):
+        try:
+            client = get_google_sheet_client()
+            sh = client.open_by_key(SPREADSHEET_KEY)
+            ws = get_worksheet_safe(sh, ["業務表單", "業務資料表", "Sheet1"], 0)
+
+            headers = []
+            for i, row in enumerate(ws.get_all_values()[:10]):
+                if "編號" in [str(r).strip() for r in row] and "日期" in [str(r).strip() for r in row]: headers = row; break
+            if not headers: return False, "找不到標題列"
+            headers = _ensure_header_columns(ws, i + 1, headers, [c for c in FX_FIELD_COLUMNS if any(c in r for r in records)])
+
+            col_index = {str(h).strip(): i for i, h in enumerate(headers)}
+            rows = []
+            for data_dict in records:
+                row_to_write = [""] * len(headers)
+                for col_name, value in data_dict.items():
+                    if col_name in col_index: row_to_write[col_index[col_name]] = "" if pd.isna(value) else str(value)
+                rows.append(row_to_write)
+            ws.append_rows(rows, value_input_option='USER_ENTERED')
+            return True, f"新增 {len(rows)} 筆紀錄"
+        except Exception as e:
+            if "503" in str(e): time.sleep(2); continue
+            return False, f"寫入失敗: {e}"
+    return False, "連線逾時"
+
+# ==========================================
+# 💱 匯率查詢與本機匯率表
+# ==========================================
+# 查過的每日匯率存到 CACHE_DIR/fx_rates.csv (date, currency, rate；rate 為 1 單位外幣兌台幣)，
+# 之後同一天的查詢直接讀表，排程也可預先下載 (warm_fx_cache)
+FX_CACHE_FILE = os.path.join(CACHE_DIR, "fx_rates.csv")
+FX_CURRENCIES = ["USD", "EUR", "JPY", "CNY", "GBP"]
+FX_LOOKBACK_DAYS = 5  # 假日沒有報價時往前找的天數
+_fx_table = {"df": None, "mtime": None}
+_fx_lock = threading.RLock()  # 讀取、合併、寫檔整段持有，避免同時寫入時互相覆蓋
+_fx_attempted = set()  # 已成功下載過的 (幣別, 起, 迄)，避免資料源本身缺漏時每次重抓；下載失敗的區間下次會重試
+
+# 每筆紀錄的結構化匯率欄位；舊資料只有 進出口匯率 文字 (get_yahoo_rate 查詢結果)，讀取時再解析
+FX_FIELD_COLUMNS = ["幣別", "匯率"]
+RATE_DESC_PATTERN = r'1\s*([A-Z]{3})\s*=\s*([\d.]+)\s*TWD'
+RATE_DESC_INVERSE_PATTERN = r'1\s*TWD\s*=\s*([\d.]+)\s*([A-Z]{3})'
+
+def _empty_fx_frame():
+    return pd.DataFrame({"date": pd.Series(dtype="datetime64[ns]"), "currency": pd.Series(dtype=object), "rate": pd.Series(dtype=float)})
+
+def load_fx_table():
+    """讀取本機匯率表；檔案有更新 (例如排程預熱) 時才重新讀取"""
+    with _fx_lock:
+        try: mtime = os.path.getmtime(FX_CACHE_FILE)
+        except OSError: mtime = None
+        if _fx_table["df"] is None or _fx_table["mtime"] != mtime:
+            _fx_table["df"] = pd.read_csv(FX_CACHE_FILE, parse_dates=["date"]) if mtime else _empty_fx_frame()
+            _fx_table["mtime"] = mtime
+        return _fx_table["df"]
+
+def _store_fx_rows(new_rows):
+    """合併新匯率到本機表 (同日同幣別以新資料為準) 並存檔"""
+    if new_rows.empty: return 0
+    with _fx_lock:
+        df = pd.concat([load_fx_table(), new_rows], ignore_index=True)
+        df = df.drop_duplicates(subset=["date", "currency"], keep="last").sort_values(["currency", "date"]).reset_index(drop=True)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = FX_CACHE_FILE + ".tmp"
+        df.to_csv(tmp_path, index=False, date_format="%Y-%m-%d")
+        os.replace(tmp_path, FX_CACHE_FILE)
+        _fx_table["df"], _fx_table["mtime"] = df, os.path.getmtime(FX_CACHE_FILE)
+    return len(new_rows)
+
+def _download_fx_history(currency, start, end):
+    """下載 [start, end] 期間的每日收盤匯率"""
+    yf = importlib.import_module("yfinance")
+    end_d = (pd.Timestamp(end) + timedelta(days=1)).strftime("%Y-%m-%d")
+    df = yf.download(f"{currency}TWD=X", start=pd.Timestamp(start).strftime("%Y-%m-%d"), end=end_d, progress=False)
+    if df.empty: return _empty_fx_frame()
+    close = df['Close']
+    if isinstance(close, pd.DataFrame): close = close.iloc[:, 0]
+    idx = pd.to_datetime(close.index)
+    if idx.tz is not None: idx = idx.tz_localize(None)
+    return pd.DataFrame({"date": idx.normalize(), "currency": currency, "rate": close.to_numpy(dtype=float)}).dropna(subset=["rate"])
+
+def warm_fx_cache(currencies=FX_CURRENCIES, days=30):
+    """預先下載最近 days 天的匯率到本機表；回傳 {幣別: 筆數或錯誤訊息}"""
+    end = pd.Timestamp.today().normalize()
+    start = end - timedelta(days=days)
+    result = {}
+    for currency in currencies:
+        try: result[currency] = _store_fx_rows(_download_fx_history(currency, start, end))
+        except Exception as e: result[currency] = f"error: {e}"
+    return result
+
+def get_yahoo_rate(target_currency, query_date, inverse=False):
+    try:
+        q = pd.Timestamp(query_date).normalize()
+        table = load_fx_table()
+        hit = table[(table["currency"] == target_currency) & (table["date"] == q)]
+        if hit.empty:
+            # 本機表沒有當天的匯率時先向資料源查詢；當天沒有報價 (假日) 才採用往前 FX_LOOKBACK_DAYS 天內最近一天的匯率
+            fetched = _download_fx_history(target_currency, q - timedelta(days=FX_LOOKBACK_DAYS - 1), q)
+            _store_fx_rows(fetched)
+            table = load_fx_table()
+            hit = table[(table["currency"] == target_currency) & (table["date"] <= q) & (table["date"] > q - timedelta(days=FX_LOOKBACK_DAYS))]
+        if not hit.empty:
+            row = hit.sort_values("date").iloc[-1]
+            raw_rate, rate_date = float(row["rate"]), row["date"].date()
+            if inverse: return 1 / raw_rate, rate_date, None
+            else: return raw_rate, rate_date, None
+    except: pass
+    return None, None, "無法取得匯率"
+
+def parse_rate_description(text):
+    """解析匯率文字 (例如 "2024/01/02 1 USD = 31.234 TWD")；回傳 (幣別, 1 單位外幣兌台幣)，無法解析時回傳 (None, None)"""
+    m = re.search(RATE_DESC_PATTERN, str(text))
+    if m: return m.group(1), float(m.group(2))
+    m = re.search(RATE_DESC_INVERSE_PATTERN, str(text))
+    if m and float(m.group(1)) > 0: return m.group(2), 1 / float(m.group(1))
+    return None, None
+
+def _build_fx_fields(df):
+    """每列的幣別與匯率 (1 單位外幣兌台幣)：優先使用 幣別 / 匯率 欄位，否則從 進出口匯率 文字解析"""
+    currency = pd.Series(None, index=df.index, dtype=object)
+    rate = pd.Series(np.nan, index=df.index)
+    if '進出口匯率' in df.columns:
+        text = df['進出口匯率'].astype(str)
+        fwd = text.str.extract(RATE_DESC_PATTERN)
+        inv = text.str.extract(RATE_DESC_INVERSE_PATTERN)
+        inv_rate = 1 / pd.to_numeric(inv[0], errors='coerce')
+        currency = fwd[0].fillna(inv[1]).astype(object)
+        rate = pd.to_numeric(fwd[1], errors='coerce').fillna(inv_rate.where(np.isfinite(inv_rate)))
+    if '幣別' in df.columns:
+        cur = df['幣別'].astype(str).str.strip().str.upper()
+        currency = cur.where(~cur.isin(["", "NAN", "NONE"]), currency)
+    if '匯率' in df.columns:
+        own = pd.to_numeric(df['匯率'].astype(str).str.replace(',', ''), errors='coerce')
+        rate = own.where(own > 0, rate)
+    return pd.DataFrame({"currency": currency, "rate": rate.astype(float)}, index=df.index)
+
+ROW_BUILDERS["fx_fields"] = (_build_fx_fields, True)
+
+def fx_table_version():
+    """本機匯率表的版本 (檔案修改時間)，可作為換算結果的快取鍵"""
+    load_fx_table()
+    return _fx_table["mtime"]
+
+FX_RANGE_GAP_DAYS = 30  # 缺漏日期相距不超過此天數時合併成同一段下載
+
+def fx_missing_ranges(currency, dates):
+    """
+    找出本機匯率表無法涵蓋的日期 (當天或往前 FX_LOOKBACK_DAYS 天內都沒有匯率)，
+    合併成 [(起, 迄), ...] 區間；只看今天以前的日期
+    """
+    today = pd.Timestamp.today().normalize()
+    needed = pd.Series(pd.to_datetime(pd.Series(dates)).dropna().dt.normalize().unique()).astype("datetime64[ns]")
+    needed = needed[needed <= today].sort_values().reset_index(drop=True)
+    if needed.empty: return []
+    table = load_fx_table()
+    rates = table.loc[table["currency"] == currency, ["date", "rate"]].astype({"date": "datetime64[ns]"}).sort_values("date")
+    covered = pd.merge_asof(pd.DataFrame({"date": needed}), rates, on="date", direction="backward",
+                            tolerance=timedelta(days=FX_LOOKBACK_DAYS))["rate"].notna().to_numpy()
+    missing = needed[~covered]
+    if missing.empty: return []
+    new_range = missing.diff() > timedelta(days=FX_RANGE_GAP_DAYS)
+    return [(grp.iloc[0], grp.iloc[-1]) for _, grp in missing.groupby(new_range.cumsum())]
+
+def ensure_fx_history(currency, dates):
+    """確認本機匯率表涵蓋 dates 中每一天；逐段下載缺漏的區間。回傳是否有新資料"""
+    if currency == "TWD": return False
+    margin = timedelta(days=FX_LOOKBACK_DAYS)
+    stored = 0
+    for start, end in fx_missing_ranges(currency, dates):
+        key = (currency, start, end)
+        if key in _fx_attempted: continue
+        try: stored += _store_fx_rows(_download_fx_history(currency, start - margin, end))
+        except Exception as e: logger.warning("FX download failed: %s", e); continue
+        _fx_attempted.add(key)
+    return stored > 0
+
+def convert_revenue(df, price_col, currency, fx_fields=None):
+    """
+    將台幣金額換算成 currency (向量化)。紀錄本身的幣別相同且有匯率時使用紀錄匯率，
+    否則以本機匯率表中紀錄日期當天或之前 FX_LOOKBACK_DAYS 天內最近一天的匯率 (as-of merge)。
+    回傳與 df 同索引的 Series；找不到匯率的紀錄為 NaN。
+    """
+    amounts = df[price_col].astype(float)
+    if currency == "TWD": return amounts
+    table = load_fx_table()
+    rates = table.loc[table["currency"] == currency, ["date", "rate"]].astype({"date": "datetime64[ns]"}).sort_values("date")
+    rate = pd.Series(np.nan, index=df.index)
+    if not rates.empty:
+        left = pd.DataFrame({"date": df["parsed_date"].astype("datetime64[ns]").to_numpy(), "pos": np.arange(len(df))})
+        left = left.dropna(subset=["date"]).sort_values("date")
+        back = pd.merge_asof(left, rates, on="date", direction="backward", tolerance=timedelta(days=FX_LOOKBACK_DAYS))
+        # 往前找不到匯率時 (例如早於匯率表第一天)，允許往後找幾天內的匯率
+        fwd = pd.merge_asof(left, rates, on="date", direction="forward", tolerance=timedelta(days=FX_LOOKBACK_DAYS))
+        values = np.full(len(df), np.nan)
+        values[back["pos"].to_numpy()] = back["rate"].fillna(fwd["rate"]).to_numpy()
+        rate = pd.Series(values, index=df.index)
+    if fx_fields is not None:
+        own = fx_fields.reindex(df.index)
+        use_own = (own["currency"] == currency) & (own["rate"] > 0)
+        rate = rate.where(~use_own, own["rate"])
+    return amounts / rate
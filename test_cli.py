@@ -0,0 +1,46 @@
+"""
+cli.py 的測試 (以假的快照取代 Google Sheets，不需要金鑰)。
+
+用法：
+    python -m pytest -q test_cli.py
+"""
+import json
+
+import pandas as pd
+
+import cli
+import core
+
+EXISTING = pd.DataFrame({
+    '編號': ['3', '4', '9'],
+    '日期': ['2024-01-05', '2024-02-01', '2025-01-03'],
+    '客戶名稱': ['甲公司', '乙公司', '丙公司'],
+})
+
+def run_import(tmp_path, monkeypatch, capsys, rows):
+    monkeypatch.setattr(cli, "load_snapshot", lambda: core.DataSnapshot(1, {}, EXISTING, {}, {}))
+    path = tmp_path / "new.csv"
+    pd.DataFrame(rows, columns=['編號', '日期', '客戶名稱']).to_csv(path, index=False)
+    code = cli.main(["import", str(path)])
+    return code, json.loads(capsys.readouterr().out)
+
+def test_import_numbers_after_explicit_ids_in_the_same_file(tmp_path, monkeypatch, capsys):
+    code, result = run_import(tmp_path, monkeypatch, capsys, [
+        ['', '2024-03-01', '丁公司'],
+        ['5', '2024-03-02', '戊公司'],
+        ['', '2025-03-03', '己公司'],
+    ])
+    assert code == 0
+    assert result["ids"] == [6, '5', 10]
+    assert result["invalid"] == 0
+
+def test_import_reports_ids_that_already_exist(tmp_path, monkeypatch, capsys):
+    code, result = run_import(tmp_path, monkeypatch, capsys, [
+        ['04', '2024-03-01', '丁公司'],
+        ['7', '2024-03-02', '戊公司'],
+        ['7', '2024-03-03', '己公司'],
+        ['4', '2025-03-04', '庚公司'],
+    ])
+    assert code == 0
+    assert result["ids"] == ['7', '4']
+    assert [e["line"] for e in result["errors"]] == [2, 4]
@@ -0,0 +1,237 @@
+"""
+core.py 的資料快照測試：增量更新的逐列衍生表必須與完整重建的結果一致。
+
+用法：
+    python -m pytest -q test_core.py
+"""
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pytest
+
+import core
+
+COLUMNS = ['編號', '日期', '客戶類別', '客戶名稱', '完稅價格', '發票日期', '收款日期', '進出口匯率']
+
+BASE_ROWS = [
+    ['1', '2024-01-05', '工程', '甲公司', '1,000', '2024-01-10', '2024-02-01', ''],
+    ['2', '2024-02-10', '貿易', '乙公司', '2000', '', '', '2024/02/10 1 USD = 31.2 TWD'],
+    ['3', '113/3/1', '工程', '丙公司', '300', '2024-03-05,2024-03-20', '2024-04-01', ''],
+    ['1', '2025-01-03', '五金', '丁公司', '500', '', '', ''],
+    ['2', '2025-01-08', '五金', '戊公司', '800', '', '', '1 TWD = 0.0325 USD'],
+]
+
+def make_df(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def edit(rows, idx, col, value):
+    rows = [list(r) for r in rows]
+    rows[idx][COLUMNS.index(col)] = value
+    return rows
+
+SCENARIOS = {
+    "edit_price_without_invoice": edit(BASE_ROWS, 1, '完稅價格', '2500'),
+    "edit_invoice_dates": edit(BASE_ROWS, 2, '收款日期', '2024-04-01,2024-04-15'),
+    "delete_row": BASE_ROWS[:1] + BASE_ROWS[2:],
+    "insert_row": BASE_ROWS + [['3', '2025-02-01', '工程', '己公司', '900', '2025-02-03', '', '']],
+    "move_row": [BASE_ROWS[3]] + BASE_ROWS[:3] + BASE_ROWS[4:],
+}
+
+def snapshot_pair(old_rows, new_rows):
+    """回傳 (以上一版增量更新的快照, 完整重建的快照)"""
+    old = core.DataSnapshot(1, {}, make_df(old_rows), {}, {})
+    for name in core.ROW_BUILDERS: old.get_rows(name)
+    incremental = core.DataSnapshot(2, {}, make_df(new_rows), {}, {}, previous=old)
+    incremental.carry_forward()
+    return incremental, core.DataSnapshot(2, {}, make_df(new_rows), {}, {})
+
+def assert_rows_equal(name, incremental, full):
+    _, keep_order = core.ROW_BUILDERS[name]
+    if not keep_order:
+        incremental, full = (df.sort_index(kind="stable") for df in (incremental, full))
+    pd.testing.assert_frame_equal(incremental, full)
+
+@pytest.mark.parametrize("name", list(core.ROW_BUILDERS))
+@pytest.mark.parametrize("scenario", list(SCENARIOS))
+def test_incremental_rows_match_full_rebuild(name, scenario):
+    incremental, full = snapshot_pair(BASE_ROWS, SCENARIOS[scenario])
+    assert incremental.delta is not None
+    assert_rows_equal(name, incremental.get_rows(name), full.get_rows(name))
+
+@pytest.mark.parametrize("name", list(core.ROW_BUILDERS))
+def test_first_invoice_added_to_snapshot_without_invoices(name):
+    old_rows = [edit(BASE_ROWS, i, '發票日期', '')[i] for i in range(len(BASE_ROWS))]
+    new_rows = edit(old_rows, 1, '發票日期', '2024-02-15')
+    incremental, full = snapshot_pair(old_rows, new_rows)
+    assert_rows_equal(name, incremental.get_rows(name), full.get_rows(name))
+
+def test_receivables_report_after_incremental_update():
+    incremental, full = snapshot_pair(BASE_ROWS, SCENARIOS["edit_price_without_invoice"])
+    report = core.build_receivables_report(incremental)
+    expected = core.build_receivables_report(full)
+    assert report["outstanding_total"] == expected["outstanding_total"]
+    assert report["outstanding_count"] == expected["outstanding_count"]
+
+def test_date_series_parsing_does_not_depend_on_other_rows():
+    values = ['2024-01-05 10:30', '20240105', '113.2.3', '2024-01-05', 'abc', '']
+    parsed = core.parse_taiwan_date_series(pd.Series(values))
+    assert list(parsed) == [core.parse_taiwan_date(v) for v in values]
+    assert core.parse_taiwan_date_series(pd.Series(['20240105']))[0] == parsed[1]
+
+def test_row_keys_include_the_record_year():
+    keys = core.make_row_keys(make_df(BASE_ROWS))
+    assert list(keys) == ['2024/1', '2024/2', '2024/3', '2025/1', '2025/2']
+
+def test_row_keys_are_stable_when_a_duplicate_id_is_deleted():
+    incremental, _ = snapshot_pair(BASE_ROWS, BASE_ROWS[1:])
+    assert list(incremental.delta.deleted) == ['2024/1']
+    assert len(incremental.delta.updated) == 0 and len(incremental.delta.inserted) == 0
+
+@pytest.fixture
+def fx_table(tmp_path, monkeypatch):
+    """以暫存目錄中的匯率表取代本機匯率表：2019-03 的一週加上最近 30 天的 USD 匯率"""
+    monkeypatch.setattr(core, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(core, "FX_CACHE_FILE", str(tmp_path / "fx_rates.csv"))
+    monkeypatch.setattr(core, "_fx_table", {"df": None, "mtime": None})
+    today = pd.Timestamp.today().normalize()
+    old = pd.DataFrame({"date": pd.date_range("2019-03-01", "2019-03-07"), "currency": "USD", "rate": 30.0})
+    recent = pd.DataFrame({"date": pd.date_range(today - pd.Timedelta(days=30), today), "currency": "USD", "rate": 32.0})
+    core._store_fx_rows(pd.concat([old, recent], ignore_index=True))
+    return today
+
+def test_fx_missing_ranges_finds_gaps_inside_the_table(fx_table):
+    dates = pd.to_datetime(pd.Series(["2019-03-04", "2023-06-15", "2023-06-20", "2023-09-01"]))
+    assert core.fx_missing_ranges("USD", pd.concat([dates, pd.Series([fx_table])])) == [
+        (pd.Timestamp("2023-06-15"), pd.Timestamp("2023-06-20")),
+        (pd.Timestamp("2023-09-01"), pd.Timestamp("2023-09-01")),
+    ]
+
+def test_convert_revenue_does_not_use_stale_rates(fx_table):
+    df = pd.DataFrame({"parsed_date": pd.to_datetime(["2019-03-04", "2023-06-15", fx_table]), "完稅價格": [300.0, 300.0, 320.0]})
+    converted = core.convert_revenue(df, "完稅價格", "USD")
+    assert converted.iloc[0] == pytest.approx(10.0)
+    assert pd.isna(converted.iloc[1])
+    assert converted.iloc[2] == pytest.approx(10.0)
+
+# 本機 GCIS 替身：{API 代碼: {$filter: 回傳資料}}
+GCIS_FIXTURES = {
+    core.GCIS_COMPANY_API: {
+        "Business_Accounting_NO eq 04541302": [{"Company_Name": "甲工程股份有限公司"}],
+        "Business_Accounting_NO eq 33333333": [{"Company_Name": "丙&丁有限公司"}],
+        "Business_Accounting_NO eq 44444444": [{"Company_Name": "己貿易有限公司"}],
+    },
+    core.GCIS_NAME_API: {
+        "Company_Name like 丙&丁 and Company_Status eq 01": [{"Company_Name": "丙&丁", "Business_Accounting_NO": "33333333"}],
+        "Company_Name like 己 and Company_Status eq 01": [{"Company_Name": "己貿易有限公司", "Business_Accounting_NO": "44444444"}],
+    },
+}
+
+@pytest.fixture
+def gcis_server(tmp_path, monkeypatch):
+    """啟動本機 GCIS 替身並清空查詢快取；回傳 (base_url, 收到的 $filter 清單)"""
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            flt = parse_qs(url.query)["$filter"][0]
+            requests_seen.append(flt)
+            body = json.dumps(GCIS_FIXTURES.get(url.path.rsplit("/", 1)[-1], {}).get(flt, [])).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(core, "_gcis_cache", OrderedDict())
+    monkeypatch.setattr(core, "_gcis_cache_loaded", True)
+    monkeypatch.setattr(core, "GCIS_CACHE_FILE", str(tmp_path / "gcis_cache.json"))
+    yield f"http://127.0.0.1:{server.server_address[1]}", requests_seen
+    server.shutdown()
+
+class FakeTaxSheet:
+    def __init__(self, rows): self.rows, self.batches, self.appended = rows, [], []
+    def get_all_values(self): return self.rows
+    def batch_update(self, updates): self.batches.append(updates)
+    def append_rows(self, rows, value_input_option=None): self.appended.append((rows, value_input_option))
+
+def run_enrichment(base_url):
+    company_dict = {"工程": ["甲工程", "丙&丁"], "貿易": ["己"]}
+    df_business = make_df([
+        ['1', '2024-01-05', '工程', '丙&丁', '100', '', '', ''],
+        ['2', '2024-01-06', '貿易', '庚', '100', '', '', ''],
+        ['3', '2024-01-07', '', '辛', '100', '', '', ''],
+    ]).assign(統一編號=['33333333', '44444444', '55555555'])
+    tax_map = {"甲工程": "04541302"}
+    rev_tax_map = {"04541302": {"name": "甲工程", "cat": ""}}
+    return core.bulk_enrich_tax_ids(company_dict, df_business, tax_map, rev_tax_map, rate_per_sec=100, base_url=base_url)
+
+def test_bulk_enrich_against_local_gcis(gcis_server, monkeypatch):
+    base_url, requests_seen = gcis_server
+    report = run_enrichment(base_url)
+    status = {(r["動作"], r["客戶名稱"]): (r["狀態"], r["統一編號"], r["寫入"]) for r in report}
+    assert status == {
+        ("核對", "甲工程"): ("🏷️ 補上類別", "04541302", True),
+        ("補統編", "丙&丁"): ("🆕 新增統編", "33333333", True),
+        ("補統編", "己"): ("🆕 新增統編", "44444444", True),
+        ("補名稱", "丙&丁"): ("🆕 新增統編", "33333333", True),
+        ("補名稱", "庚"): ("🆕 新增統編", "44444444", True),
+        ("補名稱", "辛"): ("❌ 查無資料", "55555555", False),
+    }
+    assert "Company_Name like 丙&丁 and Company_Status eq 01" in requests_seen
+
+    # 第二次執行全部命中快取，不再打 API
+    n_requests = len(requests_seen)
+    assert run_enrichment(base_url) == report
+    assert len(requests_seen) == n_requests
+
+    sheet = FakeTaxSheet([["類別", "名稱", "統編"], ["", "甲工程", "04541302"]])
+    monkeypatch.setattr(core, "get_google_sheet_client", lambda: type("Client", (), {"open_by_key": lambda self, key: None})())
+    monkeypatch.setattr(core, "get_worksheet_safe", lambda sh, names, idx: sheet)
+    success, msg = core.write_enrichment_to_sheet(report)
+    assert success
+    assert sheet.batches == [[{"range": "A2", "values": [["工程"]]}]]
+    assert sheet.appended == [([["工程", "丙&丁", "33333333"]], "RAW")]
+    assert "44444444" in msg and "未寫入" in msg
+
+def test_concurrent_fx_stores_keep_every_currency(fx_table):
+    rows = [pd.DataFrame({"date": pd.date_range("2020-01-01", periods=50), "currency": cur, "rate": 1.0}) for cur in ["EUR", "JPY", "GBP", "CNY"]]
+    workers = [threading.Thread(target=core._store_fx_rows, args=(r,)) for r in rows]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    assert set(core.load_fx_table()["currency"]) == {"USD", "EUR", "JPY", "GBP", "CNY"}
+
+def test_failed_fx_download_is_retried(fx_table, monkeypatch):
+    monkeypatch.setattr(core, "_fx_attempted", set())
+    calls = []
+    def download(currency, start, end):
+        calls.append((start, end))
+        if len(calls) == 1: raise ConnectionError("offline")
+        return pd.DataFrame({"date": pd.date_range(start, end), "currency": currency, "rate": 31.0})
+    monkeypatch.setattr(core, "_download_fx_history", download)
+    dates = pd.Series(pd.to_datetime(["2023-06-15"]))
+    assert core.ensure_fx_history("USD", dates) is False
+    assert core.ensure_fx_history("USD", dates) is True
+    assert core.fx_missing_ranges("USD", dates) == [] and len(calls) == 2
+
+def test_yahoo_rate_fetches_the_exact_date_before_using_older_cached_rates(fx_table, monkeypatch):
+    yesterday = fx_table - pd.Timedelta(days=1)
+    table = core.load_fx_table()
+    table[table["date"] <= yesterday].to_csv(core.FX_CACHE_FILE, index=False, date_format="%Y-%m-%d")
+    core._fx_table.update(df=None, mtime=None)
+    quotes = {fx_table: 33.0}
+    def download(currency, start, end):
+        dates = [d for d in pd.date_range(start, end) if d in quotes]
+        return pd.DataFrame({"date": pd.DatetimeIndex(dates), "currency": currency, "rate": [quotes[d] for d in dates]})
+    monkeypatch.setattr(core, "_download_fx_history", download)
+    assert core.get_yahoo_rate("USD", fx_table)[:2] == (33.0, fx_table.date())
+
+    quotes.clear()  # 當天沒有報價時採用最近一天的本機匯率
+    assert core.get_yahoo_rate("USD", fx_table + pd.Timedelta(days=1))[:2] == (33.0, fx_table.date())